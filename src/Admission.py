@@ -0,0 +1,147 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+# Operations that make us read and serialize many posts
+EXPENSIVE = {"subscribe", "request posts", "request missing", "digest", "snapshot index", "snapshot segment"}
+
+
+class TokenBucket:
+    """Allows `rate` requests per second on average, with bursts of up to `burst`"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Takes a token if there is one"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+def claimed_sender(message):
+    """Sender a request claims to come from, None if it has none
+
+    Nothing checks it, so it only tells apart peers sharing an address, within that address's limits.
+    """
+    sender = message.get("sender")
+    return sender if isinstance(sender, str) else None
+
+
+class Admission:
+    """Limits what each peer can make the receiver do
+
+    Every address has a token bucket and a cap on open connections, and the node a cap on all of them;
+    connections left idle are closed. Nodes sharing an address (behind a NAT, or on loopback) are told
+    apart by the sender their requests claim, each with a smaller bucket and cap of its own, but all of
+    them together stay within the address's. Expensive operations share a few slots, with a bounded
+    queue in front of them; requests that find it full are shed with a busy reply.
+    """
+
+    def __init__(self, metrics, rate=20, burst=40, address_rate=200, address_burst=400, connections_per_peer=8,
+                 connections_per_address=64, senders_per_address=64, max_connections=1024, idle_timeout=60,
+                 max_message_size=1 << 20, expensive_slots=4, queue_size=32, queue_timeout=2, max_posts_per_reply=512,
+                 max_authors_per_request=64, max_ranges_per_author=1024, max_peers=4096):
+        self.metrics = metrics
+        self.rate = rate
+        self.burst = burst
+        self.address_rate = address_rate
+        self.address_burst = address_burst
+        self.connections_per_peer = connections_per_peer
+        self.connections_per_address = connections_per_address
+        self.senders_per_address = senders_per_address
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.open = 0
+        self.max_message_size = max_message_size
+        self.max_posts_per_reply = max_posts_per_reply
+        self.max_authors_per_request = max_authors_per_request
+        self.max_ranges_per_author = max_ranges_per_author
+        self.max_peers = max_peers
+        self.buckets = OrderedDict()
+        self.connections = {}
+        self.slots = asyncio.Semaphore(expensive_slots)
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.waiting = 0
+
+    def accept(self):
+        """Counts a new connection, False if the node already has too many open"""
+        if self.open >= self.max_connections:
+            self.metrics.inc("receiver_shed_total", reason="connections")
+            return False
+        self.open += 1
+        return True
+
+    def close(self):
+        """Counts a closed connection"""
+        self.open -= 1
+
+    def connect(self, address, sender=None):
+        """Counts a connection once its first request tells who sent it, False if its address or sender has too many"""
+        if (self.connections.get(address, 0) >= self.connections_per_address
+                or self.connections.get((address, sender), 0) >= self.connections_per_peer):
+            self.metrics.inc("receiver_shed_total", reason="connections")
+            return False
+        for key in (address, (address, sender)):
+            self.connections[key] = self.connections.get(key, 0) + 1
+        return True
+
+    def disconnect(self, address, sender=None):
+        """Counts a closed connection of an address and sender"""
+        for key in (address, (address, sender)):
+            self.connections[key] -= 1
+            if self.connections[key] == 0:
+                del self.connections[key]
+
+    def allow(self, address, sender=None):
+        """Takes a token from the buckets of a sender and of its address, False if either is sending too fast"""
+        entry = self.buckets.get(address)
+        if entry is None:
+            entry = self.buckets[address] = (TokenBucket(self.address_rate, self.address_burst), OrderedDict())
+            # Only the most recently seen addresses are remembered
+            while len(self.buckets) > self.max_peers:
+                self.buckets.popitem(last=False)
+        self.buckets.move_to_end(address)
+        bucket, senders = entry
+        if sender is not None:
+            sender_bucket = senders.get(sender)
+            if sender_bucket is None:
+                sender_bucket = senders[sender] = TokenBucket(self.rate, self.burst)
+                # Made-up senders only push out those of the same address
+                while len(senders) > self.senders_per_address:
+                    senders.popitem(last=False)
+            senders.move_to_end(sender)
+            if not sender_bucket.take():
+                self.metrics.inc("receiver_shed_total", reason="rate")
+                return False
+        if not bucket.take():
+            self.metrics.inc("receiver_shed_total", reason="rate")
+            return False
+        return True
+
+    async def enter(self):
+        """Waits for a slot to run an expensive operation, False if the queue is full or the wait too long"""
+        if self.slots.locked() and self.waiting >= self.queue_size:
+            self.metrics.inc("receiver_shed_total", reason="queue")
+            return False
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.queue_timeout)
+            return True
+        except asyncio.TimeoutError:
+            self.metrics.inc("receiver_shed_total", reason="timeout")
+            return False
+        finally:
+            self.waiting -= 1
+
+    def leave(self):
+        """Frees the slot taken by an expensive operation"""
+        self.slots.release()
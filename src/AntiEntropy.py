@@ -0,0 +1,225 @@
+import asyncio
+import hashlib
+import logging
+import random
+import time
+from IdRanges import contains
+from Scheduler import MAINTENANCE
+
+log = logging.getLogger(__name__)
+
+
+def bucket_ranges(ranges, bucket, bucket_size):
+    """Part of a list of id ranges falling in a bucket"""
+    first, last = bucket * bucket_size, (bucket + 1) * bucket_size - 1
+    return [[max(start, first), min(end, last)] for start, end in ranges if start <= last and end >= first]
+
+
+def clip(ranges, floor):
+    """Part of a list of id ranges from floor on"""
+    return [[max(start, floor), end] for start, end in ranges if end >= floor]
+
+
+def digest(ranges, bucket_size, parents=None, fanout=16):
+    """Hashes the ids held in each bucket of `bucket_size` ids, given them as ranges
+
+    With parents, only the buckets within those buckets of the level above (`fanout` times larger) are hashed.
+    Equal sets of ids have equal ranges, so buckets holding the same ids on two peers hash the same.
+    """
+    if parents is None:
+        buckets = set()
+        for start, end in ranges:
+            buckets.update(range(start // bucket_size, end // bucket_size + 1))
+    else:
+        buckets = {child for parent in parents for child in range(parent * fanout, (parent + 1) * fanout)}
+    hashes = {}
+    for bucket in sorted(buckets):
+        held = bucket_ranges(ranges, bucket, bucket_size)
+        if held:
+            hashes[str(bucket)] = hashlib.blake2b(repr(held).encode(), digest_size=8).hexdigest()
+    return hashes
+
+
+def differing_buckets(ours, theirs):
+    """Buckets whose hashes differ between two digests, or that only one of them has"""
+    return sorted(int(bucket) for bucket in ours.keys() | theirs.keys() if ours.get(bucket) != theirs.get(bucket))
+
+
+class AntiEntropy:
+    """Periodically compares the posts held for each followed author with another of its subscribers
+
+    Peers exchange hashes of the ids they hold per author, starting from a few large buckets and only
+    descending into the ones that differ, `fanout` times smaller each round, so the exchange grows with
+    the differences rather than with the history. Once down to buckets of `bucket_size` ids, the posts
+    in those that differ are pulled from or pushed to the other side. Ids below the floor of either
+    side, where posts were evicted, aren't compared.
+    """
+
+    def __init__(self, user, interval=60, bucket_size=64, fanout=16, max_push=512, max_authors=16, max_descend=16):
+        self.user = user
+        self.interval = interval
+        self.bucket_size = bucket_size
+        self.fanout = fanout
+        self.max_push = max_push
+        # Bound the size of every digest exchanged: authors per message and buckets descended into per author
+        self.max_authors = max_authors
+        self.max_descend = max_descend
+
+    def top_size(self, ranges):
+        """Size of the buckets that cover the ids held in at most `fanout` of them"""
+        size = self.bucket_size
+        last = ranges[-1][1] if ranges else 0
+        while last // size >= self.fanout:
+            size *= self.fanout
+        return size
+
+    def is_level(self, size):
+        """Checks whether a bucket size is one of the levels, bucket_size times a power of fanout"""
+        if not isinstance(size, int) or size < self.bucket_size:
+            return False
+        while size > self.bucket_size and size % self.fanout == 0:
+            size //= self.fanout
+        return size == self.bucket_size
+
+    def digests(self, authors, scopes=None):
+        """Digest of the ids held for each of the given authors, from the top level or within the given scopes
+
+        A scope, taken from a peer's answer, gives the floor to compare from, the bucket size and the parent buckets.
+        """
+        digests = {}
+        for author in authors:
+            scope = (scopes or {}).get(author)
+            ranges = self.user.store.ranges(author)
+            floor = self.user.store.floor(author)
+            if scope is None:
+                size, parents = self.top_size(ranges), None
+            else:
+                floor, size, parents = max(floor, scope["floor"]), scope["size"], scope["parents"]
+            digests[author] = {
+                "floor": floor,
+                "size": size,
+                "parents": parents,
+                "buckets": digest(clip(ranges, floor), size, parents, self.fanout),
+            }
+        return digests
+
+    def differences(self, digests):
+        """For each author in a peer's digests, the buckets that differ from ours
+
+        Above the bottom level they are the ones to descend into, at the bottom level they come with the ids we hold in them.
+        """
+        differ = {}
+        for author, theirs in list(digests.items())[:self.max_authors]:
+            if author not in self.user.subscriptions and author != self.user.public_key:
+                continue
+            size = theirs["size"]
+            if not self.is_level(size):
+                continue
+            parents = theirs["parents"]
+            if parents is not None:
+                parents = [int(parent) for parent in parents[:self.max_descend]]
+            floor = max(self.user.store.floor(author), theirs["floor"])
+            ranges = clip(self.user.store.ranges(author), floor)
+            ours = digest(ranges, size, parents, self.fanout)
+            first_bucket = floor // size
+            their_buckets = {bucket: hash for bucket, hash in theirs["buckets"].items() if int(bucket) >= first_bucket
+                             and (parents is None or int(bucket) // self.fanout in parents)}
+            buckets = [bucket for bucket in differing_buckets(ours, their_buckets) if bucket >= first_bucket]
+            if not buckets:
+                continue
+            if size == self.bucket_size:
+                buckets = buckets[:self.max_descend * self.fanout]
+                differ[author] = {
+                    "floor": floor,
+                    "buckets": buckets,
+                    "have": [held for bucket in buckets for held in bucket_ranges(ranges, bucket, size)],
+                }
+            else:
+                differ[author] = {"floor": floor, "size": size // self.fanout, "descend": buckets[:self.max_descend]}
+        return differ
+
+    async def run(self):
+        """Runs a round every interval, starting at a random point so peers don't all go at once"""
+        await asyncio.sleep(random.uniform(0, self.interval))
+        while True:
+            try:
+                await self.user.schedule(MAINTENANCE, self.round, ("anti-entropy",))
+            except Exception as e:
+                log.warning("Anti-entropy Exception %s", e)
+            await asyncio.sleep(self.interval)
+
+    async def round(self):
+        """Reconciles every subscription with one of its other subscribers, several authors per peer"""
+        self.user.metrics.inc("anti_entropy_rounds_total")
+        authors = sorted(self.user.subscriptions)
+        authors_subscribers = await self.user.fanout.run(authors, self.user.subscribers_of)
+        shared = {}
+        for author, subscribers in authors_subscribers.items():
+            if isinstance(subscribers, list):
+                others = [sub for sub in subscribers if sub != self.user.public_key]
+                if others:
+                    shared.setdefault(random.choice(others), []).append(author)
+        return await self.user.fanout.run(list(shared), lambda sub: self.reconcile(sub, shared[sub]))
+
+    async def reconcile(self, public_key, authors):
+        """Exchanges digests of the given authors with a peer, a few at a time, and repairs the buckets that differ"""
+        for start in range(0, len(authors), self.max_authors):
+            ans = await self.reconcile_some(public_key, authors[start:start + self.max_authors])
+            if ans[0] != 0:
+                return ans
+        return (0, "Reconciled")
+
+    async def reconcile_some(self, public_key, authors):
+        """Descends into the buckets that differ with a peer, round by round, then repairs them"""
+        pull = []
+        pending, scopes = list(authors), None
+        while pending:
+            digests = self.digests(pending, scopes)
+            message = {
+                "op": "digest",
+                "sender": self.user.public_key,
+                "digests": digests,
+                "timestamp": time.time(),
+            }
+            ans = await self.user.send_to_peer(public_key, message)
+            if ans[0] != 0:
+                return (-1, "Didn't reconcile. Peer unavailable")
+
+            scopes = {}
+            for author, differ in ans[2]["differ"].items():
+                if author not in digests:
+                    continue
+                if "descend" in differ:
+                    # Each round goes a level down, so the exchange always ends
+                    if differ["size"] * self.fanout == digests[author]["size"] and self.is_level(differ["size"]):
+                        scopes[author] = {"floor": differ["floor"], "size": differ["size"],
+                                          "parents": differ["descend"][:self.max_descend]}
+                    continue
+                if digests[author]["size"] != self.bucket_size:
+                    continue
+                if await self.repair(public_key, author, differ):
+                    pull.append(author)
+            pending = list(scopes)
+
+        if pull:
+            self.user.metrics.inc("anti_entropy_repairs_total", len(pull), direction="pull")
+            await self.user.request_missing(public_key, pull)
+        return (0, "Reconciled")
+
+    async def repair(self, public_key, author, differ):
+        """Pushes the posts a peer lacks in the differing bottom buckets, True if it has some we lack"""
+        ours = clip(self.user.store.ranges(author), differ["floor"])
+        # Only what falls in a bounded number of bottom buckets is looked at, whatever the peer sent
+        buckets = sorted(int(bucket) for bucket in differ["buckets"])[:self.max_descend * self.fanout]
+        theirs = [held for bucket in buckets for held in bucket_ranges(sorted(differ["have"]), bucket, self.bucket_size)]
+        ids = [id for bucket in buckets for start, end in bucket_ranges(ours, bucket, self.bucket_size)
+               for id in range(start, end + 1) if not contains(theirs, id)]
+        posts = {}
+        for id in ids[:self.max_push]:
+            post = self.user.store.get(author, id)
+            if post is not None:
+                posts[id] = post
+        if posts:
+            self.user.metrics.inc("anti_entropy_repairs_total", direction="push")
+            await self.user.send_push(public_key, author, posts, max(posts), [])
+        return any(not contains(ours, id) for start, end in theirs for id in range(start, end + 1))
@@ -0,0 +1,125 @@
+import base64
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 0
+MSGPACK = 1
+# Set in a frame's flags byte when its body is zlib compressed
+COMPRESSED = 0x80
+
+PEM_HEADER = "-----BEGIN PUBLIC KEY-----\n"
+PEM_FOOTER = "\n-----END PUBLIC KEY-----\n"
+# DER prefix of an Ed25519 SubjectPublicKeyInfo, followed by the 32 raw key bytes
+ED25519_PREFIX = bytes.fromhex("302a300506032b6570032100")
+
+# msgpack extension types
+KEY_EXT = 1
+SIGNATURE_EXT = 2
+
+
+def supported_codecs():
+    """Bitmask of the codecs this node can decode"""
+    mask = 1 << JSON
+    if msgpack is not None:
+        mask |= 1 << MSGPACK
+    return mask
+
+
+def choose_codec(mask):
+    """Picks the most compact codec both sides support"""
+    if mask & supported_codecs() & (1 << MSGPACK):
+        return MSGPACK
+    return JSON
+
+
+def pem_to_raw(public_key):
+    """Returns the raw 32 bytes of an Ed25519 PEM public key, or None if it isn't one"""
+    if not public_key.startswith(PEM_HEADER) or not public_key.endswith(PEM_FOOTER):
+        return None
+    try:
+        der = base64.b64decode(public_key[len(PEM_HEADER):-len(PEM_FOOTER)], validate=True)
+    except ValueError:
+        return None
+    if len(der) != len(ED25519_PREFIX) + 32 or not der.startswith(ED25519_PREFIX):
+        return None
+    raw = der[len(ED25519_PREFIX):]
+    # Only keys that are rebuilt into the exact same string can be sent compactly
+    if raw_to_pem(raw) != public_key:
+        return None
+    return raw
+
+
+def raw_to_pem(raw):
+    """Rebuilds the PEM public key from its raw 32 bytes"""
+    return PEM_HEADER + base64.b64encode(ED25519_PREFIX + raw).decode('utf-8') + PEM_FOOTER
+
+
+def compact(value):
+    """Replaces PEM keys and base64 signatures with msgpack extension types holding raw bytes"""
+    if isinstance(value, dict):
+        result = {}
+        for key, item in value.items():
+            if key == "signature" and isinstance(item, str):
+                item = compact_signature(item)
+            else:
+                item = compact(item)
+            result[compact(key)] = item
+        return result
+    if isinstance(value, list):
+        return [compact(item) for item in value]
+    if isinstance(value, str) and value.startswith(PEM_HEADER):
+        raw = pem_to_raw(value)
+        if raw is not None:
+            return msgpack.ExtType(KEY_EXT, raw)
+    return value
+
+
+def compact_signature(signature):
+    """Wraps the raw bytes of a base64 signature, leaving malformed ones untouched"""
+    try:
+        return msgpack.ExtType(SIGNATURE_EXT, base64.b64decode(signature, validate=True))
+    except ValueError:
+        return signature
+
+
+def expand(code, data):
+    """Turns msgpack extension types back into PEM keys and base64 signatures"""
+    if code == KEY_EXT:
+        return raw_to_pem(data)
+    if code == SIGNATURE_EXT:
+        return base64.b64encode(data).decode('utf-8')
+    return msgpack.ExtType(code, data)
+
+
+def encode(message, codec=JSON, compress_threshold=1024):
+    """Encodes a message as a flags byte followed by the body"""
+    if codec == MSGPACK:
+        body = msgpack.packb(compact(message), use_bin_type=True)
+    else:
+        body = json.dumps(message).encode()
+    flags = codec
+    if len(body) > compress_threshold:
+        compressed = zlib.compress(body)
+        if len(compressed) < len(body):
+            body = compressed
+            flags |= COMPRESSED
+    return bytes([flags]) + body
+
+
+def decode(data, max_size=None):
+    """Decodes a message encoded with encode, refusing those inflating to more than max_size bytes"""
+    flags = data[0]
+    body = data[1:]
+    if flags & COMPRESSED:
+        decompressor = zlib.decompressobj()
+        body = decompressor.decompress(body, max_size or 0)
+        if decompressor.unconsumed_tail:
+            raise ValueError(f"Frame inflating to over {max_size} bytes")
+    if flags & ~COMPRESSED == MSGPACK:
+        return msgpack.unpackb(body, raw=False, ext_hook=expand, strict_map_key=False)
+    return json.loads(body)
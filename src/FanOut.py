@@ -0,0 +1,88 @@
+import asyncio
+
+
+class FanOut:
+    """Runs one coroutine per peer with a bounded number of requests in flight"""
+
+    def __init__(self, limit=16, timeout=5, smoothing=0.3):
+        self.limit = limit
+        self.timeout = timeout
+        # Moving average of how long each peer took to answer, failures count as a full timeout
+        self.smoothing = smoothing
+        self.latencies = {}
+
+    async def run(self, keys, request, timeout=None):
+        """Calls request(key) for every key and returns a dict with each key's result
+
+        At most `limit` requests are in flight at once and each one is given up
+        to `timeout` seconds (the fan-out's default if not given). A request that
+        fails or times out maps to its exception.
+        """
+        timeout = timeout or self.timeout
+        semaphore = asyncio.Semaphore(self.limit)
+
+        async def bounded(key):
+            async with semaphore:
+                try:
+                    return key, await asyncio.wait_for(request(key), timeout)
+                except Exception as e:
+                    return key, e
+
+        results = {}
+        for finished in asyncio.as_completed([bounded(key) for key in keys]):
+            key, result = await finished
+            results[key] = result
+        return results
+
+    def latency(self, key):
+        """Expected answer time of a peer, peers never asked sit between fast and failing ones"""
+        return self.latencies.get(key, self.timeout / 2)
+
+    def record(self, key, elapsed):
+        """Updates the moving average of a peer's answer time"""
+        previous = self.latencies.get(key, elapsed)
+        self.latencies[key] = previous + self.smoothing * (elapsed - previous)
+
+    def rank(self, keys):
+        """Sorts peers from the fastest to answer to the slowest"""
+        return sorted(keys, key=self.latency)
+
+    async def race(self, keys, request, accept, width=3):
+        """Queries peers `width` at a time and returns (key, result) of the first accepted result
+
+        Keys are tried in the given order and a new one is started whenever an attempt fails or
+        times out. The remaining attempts are cancelled once a result is accepted. Returns
+        (None, None) if no peer gave an acceptable result.
+        """
+        loop = asyncio.get_running_loop()
+
+        async def attempt(key):
+            start = loop.time()
+            try:
+                result = await asyncio.wait_for(request(key), self.timeout)
+            except Exception as e:
+                self.record(key, self.timeout)
+                return e
+            self.record(key, loop.time() - start if accept(result) else self.timeout)
+            return result
+
+        queue = iter(keys)
+        running = {}
+        try:
+            while True:
+                while len(running) < width:
+                    key = next(queue, None)
+                    if key is None:
+                        break
+                    running[asyncio.ensure_future(attempt(key))] = key
+                if not running:
+                    return (None, None)
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    key = running.pop(task)
+                    result = task.result()
+                    if not isinstance(result, Exception) and accept(result):
+                        return (key, result)
+        finally:
+            for task in running:
+                task.cancel()
@@ -0,0 +1,22 @@
+import bisect
+
+
+def contains(ranges, id):
+    """Checks whether an id is covered by a list of ranges"""
+    index = bisect.bisect_right(ranges, [id, float("inf")]) - 1
+    return index >= 0 and ranges[index][0] <= id <= ranges[index][1]
+
+
+def gaps(ranges, last):
+    """Ranges of the ids up to last not covered by a sorted list of ranges"""
+    missing = []
+    next_id = 0
+    for start, end in ranges:
+        if start > last:
+            break
+        if start > next_id:
+            missing.append([next_id, start - 1])
+        next_id = max(next_id, end + 1)
+    if next_id <= last:
+        missing.append([next_id, last])
+    return missing
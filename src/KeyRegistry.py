@@ -0,0 +1,54 @@
+import base64
+import binascii
+from Codec import PEM_HEADER, PEM_FOOTER, pem_to_raw, raw_to_pem
+
+
+class KeyRegistry:
+    """Interns public keys so each PEM string is held once, along with its compact id
+
+    The compact id of an Ed25519 key is its raw 32 bytes, other keys fall back to their encoded PEM.
+    The short form is the base64 DER body of the PEM, the one used by the HTTP API.
+    """
+
+    def __init__(self):
+        self.pems = {}
+        self.ids = {}
+
+    @staticmethod
+    def compact(public_key):
+        """Compact id of a PEM key, computed from the key alone"""
+        id = pem_to_raw(public_key)
+        return public_key.encode('utf-8') if id is None else id
+
+    def intern(self, public_key):
+        """Returns the registered copy of a PEM key, registering it if it's new
+
+        Only keys we store posts of or follow are registered, so peers naming keys don't grow the registry.
+        """
+        pem = self.pems.get(public_key)
+        if pem is None:
+            pem = self.pems[public_key] = public_key
+            self.ids[pem] = self.compact(pem)
+        return pem
+
+    def id_of(self, public_key):
+        """Compact id of a PEM key, without registering it"""
+        id = self.ids.get(public_key)
+        return self.compact(public_key) if id is None else id
+
+    def pem_of(self, id):
+        """PEM key with the given compact id"""
+        pem = raw_to_pem(id) if len(id) == 32 else id.decode('utf-8')
+        return self.intern(pem)
+
+    def short(self, public_key):
+        """Base64 body of a PEM key"""
+        return public_key[len(PEM_HEADER):-len(PEM_FOOTER)]
+
+    def from_short(self, short):
+        """PEM key with the given base64 body, raising ValueError if it isn't valid base64"""
+        try:
+            base64.b64decode(short, validate=True)
+        except binascii.Error as e:
+            raise ValueError(f"Invalid public key {short!r}") from e
+        return PEM_HEADER + short + PEM_FOOTER
@@ -0,0 +1,124 @@
+import contextvars
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger("tracing")
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+
+current_span = contextvars.ContextVar("current_span", default=None)
+span_ids = itertools.count(1)
+
+
+class Histogram:
+    """Latency histogram with fixed buckets"""
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Counters and latency histograms, optionally logging a tracing span for every timed operation"""
+
+    def __init__(self, tracing=False):
+        self.tracing = tracing
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, amount=1, **labels):
+        """Increments a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """Records a value in a histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def counter(self, name, **labels):
+        """Current value of a counter"""
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def total(self, name):
+        """Sum of a counter over all its labels"""
+        return sum(value for (counter_name, _), value in self.counters.items() if counter_name == name)
+
+    def histogram_total(self, name):
+        """Count and sum of a histogram over all its labels"""
+        histograms = [histogram for (histogram_name, _), histogram in self.histograms.items() if histogram_name == name]
+        return sum(histogram.count for histogram in histograms), sum(histogram.sum for histogram in histograms)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Times the enclosed block into the `<name>_seconds` histogram, counting failures in `<name>_errors_total`"""
+        span = None
+        if self.tracing:
+            span = next(span_ids)
+            token = current_span.set(span)
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc(name + "_errors_total", **labels)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe(name + "_seconds", elapsed, **labels)
+            if span is not None:
+                current_span.reset(token)
+                log.debug("span=%d parent=%s name=%s labels=%s duration_ms=%.3f",
+                          span, current_span.get(), name, labels, 1000 * elapsed)
+
+    def render(self):
+        """Renders every metric in the Prometheus text format"""
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    """Formats label pairs as {key="value",...}"""
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class InstrumentedDHT:
+    """Kademlia server wrapper timing every get and set"""
+
+    def __init__(self, server, metrics):
+        self.server = server
+        self.metrics = metrics
+
+    async def get(self, key):
+        with self.metrics.timer("dht_get"):
+            return await self.server.get(key)
+
+    async def set(self, key, value):
+        with self.metrics.timer("dht_set"):
+            return await self.server.set(key, value)
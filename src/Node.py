@@ -0,0 +1,134 @@
+import asyncio
+import logging
+from kademlia.network import Server
+from Receiver import Receiver
+from FanOut import FanOut
+from PeerPool import PeerPool
+from PeerCache import PeerCache
+from SubscriberShards import SubscriberShards, MergingStorage
+from PostChunks import PostChunks
+from PostStore import PostStore
+from Verifier import Verifier
+from KeyRegistry import KeyRegistry
+from Metrics import Metrics, InstrumentedDHT
+from Scheduler import Scheduler, MAINTENANCE
+
+log = logging.getLogger(__name__)
+
+
+class Node:
+    """Networking and storage shared by every user identity hosted in a process
+
+    One Kademlia server, one receiver port, one connection pool and one post store serve all the users
+    created with this node. Requests are routed to the user named in their "to" field, or to the first
+    user added if they have none, as older peers don't send it.
+    """
+
+    def __init__(self, ip, kademlia_port, receiver_port, bootstrap_nodes=[], store_file="posts.db", fanout_limit=16, peer_timeout=5, verify_executor="thread", subscriber_shards=16, tracing=False, keep_posts=None, keep_days=None, retention_interval=3600):
+        self.ip = ip
+        self.kademlia_port = kademlia_port
+        self.receiver_port = receiver_port
+        self.bootstrap_nodes = bootstrap_nodes
+        self.metrics = Metrics(tracing)
+        # Shard records written at once by several subscribers are merged by the nodes storing them
+        self.server = Server(storage=MergingStorage())
+        # Every dht get and set goes through here to be timed
+        self.dht = InstrumentedDHT(self.server, self.metrics)
+        self.peers = PeerCache(self.dht)
+        self.fanout = FanOut(fanout_limit, peer_timeout)
+        self.shards = SubscriberShards(self.dht, self.fanout, subscriber_shards)
+        self.chunks = PostChunks(self.dht, self.fanout)
+        self.pool = PeerPool(self.metrics)
+        self.verifier = Verifier(self.metrics, verify_executor)
+        # Background network work of every user, run by priority
+        self.scheduler = Scheduler(self.metrics)
+        self.keys = KeyRegistry()
+        # Posts live on disk, followed authors only keep the last keep_posts posts or keep_days days
+        self.store = PostStore(store_file, self.keys, keep_posts, keep_days)
+        # Posts past their retention are also swept periodically, authors may stop posting
+        self.retention_interval = retention_interval
+        self.receiver = Receiver(self)
+        self.users = {}
+        self.default_user = None
+        self.started = False
+        # Set once the dht server has joined the network
+        self.bootstrapped = asyncio.Event()
+        # Background tasks of the node itself, such as the handlers of framed requests
+        self.tasks = set()
+
+    def spawn(self, coroutine):
+        """Runs a coroutine in the background"""
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def register(self, user):
+        """Adds a user to the ones served by this node"""
+        self.users[user.public_key] = user
+        if self.default_user is None:
+            self.default_user = user
+        # Our own posts are never evicted
+        self.store.set_retention(user.public_key)
+
+    def route(self, message):
+        """User a request is addressed to, None if it isn't hosted here"""
+        to = message.get("to")
+        if to is None:
+            return self.default_user
+        return self.users.get(to)
+
+    def follows(self, author):
+        """Checks whether any hosted user is or follows an author"""
+        return any(author == user.public_key or author in user.subscriptions for user in self.users.values())
+
+    def release(self, author):
+        """Drops the posts of an author once no hosted user follows it anymore"""
+        if not self.follows(author):
+            self.store.drop_author(author)
+
+    async def start(self):
+        """Starts serving peers from the local state, joining the network and catching users up in the background"""
+        await self.server.listen(self.kademlia_port)
+        self.scheduler.start()
+        await self.receiver.start()
+        self.started = True
+        self.spawn(self.bootstrap())
+        if self.retention_interval is not None:
+            self.spawn(self.sweep_retention())
+        for user in list(self.users.values()):
+            user.join_in_background()
+
+    async def bootstrap(self):
+        """Bootstraps against every seed at once"""
+        seeds = [(self.ip, self.kademlia_port)] + [(node[0], node[1]) for node in self.bootstrap_nodes]
+        log.info("Bootstraping with: %s", seeds)
+        # Kademlia pings all the seeds concurrently and then looks ourselves up through the ones that answered
+        with self.metrics.timer("bootstrap"):
+            await self.server.bootstrap(seeds)
+        self.bootstrapped.set()
+
+    async def sweep_retention(self):
+        """Evicts the posts past their retention every retention_interval, starting right away"""
+        async def sweep():
+            self.store.sweep()
+
+        while True:
+            try:
+                await self.scheduler.submit(MAINTENANCE, sweep, ("retention",))
+            except Exception as e:
+                log.warning("Retention Exception %s", e)
+            await asyncio.sleep(self.retention_interval)
+
+    async def stop(self):
+        """Stops serving peers and leaves the network"""
+        await self.receiver.stop()
+        for user in list(self.users.values()):
+            await user.leave()
+        for task in list(self.tasks):
+            task.cancel()
+        await self.scheduler.stop()
+        await self.pool.close()
+        self.server.stop()
+        self.verifier.close()
+        self.store.close()
@@ -0,0 +1,67 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+class PeerCache:
+    """TTL and LRU cache of the peer records stored in the DHT"""
+
+    def __init__(self, server, ttl=60, max_size=1024, refresh_ahead=0.2):
+        self.server = server
+        self.ttl = ttl
+        self.max_size = max_size
+        # Entries with less than this fraction of their ttl left are refreshed in the background
+        self.refresh_ahead = refresh_ahead
+        self.entries = OrderedDict()
+        self.lookups = {}
+
+    async def get(self, public_key):
+        """Returns the parsed record of a peer, only looking it up in the DHT if not cached"""
+        entry = self.entries.get(public_key)
+        now = time.monotonic()
+        if entry is not None and entry[0] > now:
+            self.entries.move_to_end(public_key)
+            if entry[0] - now < self.ttl * self.refresh_ahead:
+                self.lookup(public_key)
+            return entry[1]
+        return await asyncio.shield(self.lookup(public_key))
+
+    def lookup(self, public_key):
+        """Starts a DHT lookup for a peer, sharing it with concurrent callers"""
+        task = self.lookups.get(public_key)
+        if task is None:
+            task = asyncio.ensure_future(self.fetch(public_key))
+            self.lookups[public_key] = task
+            task.add_done_callback(lambda _: self.lookup_done(public_key))
+        return task
+
+    def lookup_done(self, public_key):
+        """Forgets a finished lookup, consuming the error of background refreshes nobody awaited"""
+        task = self.lookups.pop(public_key)
+        if not task.cancelled() and task.exception() is not None:
+            log.warning("Peer Lookup Exception %s", task.exception())
+
+    async def fetch(self, public_key):
+        """Looks a peer up in the DHT and caches its record"""
+        info = await self.server.get(public_key)
+        if info is None:
+            self.entries.pop(public_key, None)
+            return None
+        info = json.loads(info)
+        self.put(public_key, info)
+        return info
+
+    def put(self, public_key, info):
+        """Caches a peer record, evicting the least recently used ones"""
+        self.entries[public_key] = (time.monotonic() + self.ttl, info)
+        self.entries.move_to_end(public_key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, public_key):
+        """Drops a peer record, e.g. after failing to reach the peer at its cached address"""
+        self.entries.pop(public_key, None)
@@ -0,0 +1,209 @@
+import asyncio
+import json
+import struct
+import time
+import Codec
+
+# Sent by a client that speaks the framed protocol, followed by the codecs it supports.
+# A receiver that does too answers with it followed by the codec chosen for the connection.
+MAGIC = b"SDLE\x02"
+HEADER = struct.Struct("!I")
+
+
+async def read_frame(reader, max_size=None, idle_timeout=None):
+    """Reads a length-prefixed frame, refusing those over max_size bytes, compressed or not
+
+    Raises asyncio.TimeoutError if no frame starts within idle_timeout seconds, leaving the stream untouched.
+    """
+    size = HEADER.unpack(await asyncio.wait_for(reader.readexactly(HEADER.size), idle_timeout))[0]
+    if max_size is not None and size > max_size:
+        raise ValueError(f"Frame of {size} bytes over the {max_size} bytes limit")
+    return Codec.decode(await reader.readexactly(size), max_size)
+
+
+def write_frame(writer, message, codec=Codec.JSON):
+    """Writes a length-prefixed frame and returns its size"""
+    data = Codec.encode(message, codec)
+    writer.write(HEADER.pack(len(data)) + data)
+    return HEADER.size + len(data)
+
+
+class Refused(ConnectionError):
+    """The peer is too busy to take the connection"""
+
+
+class PeerConnection:
+    """Long-lived framed connection to a peer, shared by many in-flight requests"""
+
+    def __init__(self, reader, writer, codec, metrics, max_frame_size=None):
+        self.reader = reader
+        self.writer = writer
+        self.codec = codec
+        self.metrics = metrics
+        self.max_frame_size = max_frame_size
+        self.pending = {}
+        self.error = None
+        self.next_request_id = 0
+        self.read_task = asyncio.ensure_future(self.read_loop())
+
+    @property
+    def closed(self):
+        return self.read_task.done()
+
+    async def read_loop(self):
+        """Resolves pending requests as their responses arrive"""
+        try:
+            while True:
+                message = await read_frame(self.reader, self.max_frame_size)
+                request_id = message.pop("rid", None)
+                if request_id is None and message.get("op") == "busy":
+                    raise Refused("Connection refused by a busy peer")
+                future = self.pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(message)
+        except Exception as e:
+            self.error = e if isinstance(e, Refused) else ConnectionError("Connection lost: " + str(e))
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(self.error)
+            self.pending.clear()
+            self.writer.close()
+
+    async def request(self, message, timeout):
+        """Sends a message tagged with a fresh request id and waits for its response"""
+        if self.error is not None:
+            raise self.error
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            self.metrics.inc("bytes_sent_total", write_frame(self.writer, {**message, "rid": request_id}, self.codec))
+            self.metrics.inc("messages_sent_total")
+            await self.writer.drain()
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def close(self):
+        """Closes the connection"""
+        self.read_task.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except Exception:
+            pass
+
+
+class PeerPool:
+    """Pool of persistent peer connections, falling back to one-shot messages for old peers"""
+
+    def __init__(self, metrics, handshake_timeout=2, request_timeout=10, max_frame_size=16 << 20, legacy_ttl=300):
+        self.handshake_timeout = handshake_timeout
+        self.request_timeout = request_timeout
+        # Responses are bounded too, so a peer can't make us inflate a huge one
+        self.max_frame_size = max_frame_size
+        self.connections = {}
+        self.connecting = {}
+        # Peers that only speak the one-shot protocol, until when, as they may be upgraded
+        self.legacy = {}
+        self.legacy_ttl = legacy_ttl
+        self.metrics = metrics
+
+    def is_legacy(self, address):
+        """Checks whether an address was recently found to only speak the one-shot protocol"""
+        expires = self.legacy.get(address)
+        if expires is not None and expires <= time.monotonic():
+            del self.legacy[address]
+            return False
+        return expires is not None
+
+    def mark_legacy(self, address):
+        """Sends the next messages to an address one-shot, until the handshake is tried again after legacy_ttl"""
+        self.legacy[address] = time.monotonic() + self.legacy_ttl
+
+    async def request(self, ip, port, message):
+        """Sends a message to the given address and returns the response"""
+        address = (ip, port)
+        for attempt in range(2):
+            if self.is_legacy(address):
+                return await self.one_shot(ip, port, message)
+            connection = await self.connect(address)
+            if connection is None:
+                break
+            try:
+                return await connection.request(message, self.request_timeout)
+            except Refused:
+                # Answered like a request shed by the peer, its address is fine
+                return {"op": "busy"}
+            except ConnectionError:
+                # A pooled connection may have gone stale, retry once on a fresh one
+                if attempt == 1:
+                    raise
+        answer = await self.one_shot(ip, port, message)
+        # Answering one-shot while leaving the handshake unanswered is how older peers behave
+        if answer is not None and answer.get("op") != "busy":
+            self.mark_legacy(address)
+        return answer
+
+    async def connect(self, address):
+        """Returns an open connection to the address, sharing concurrent connection attempts"""
+        connection = self.connections.get(address)
+        if connection is not None and not connection.closed:
+            return connection
+        task = self.connecting.get(address)
+        if task is None:
+            task = asyncio.ensure_future(self.open(address))
+            self.connecting[address] = task
+            task.add_done_callback(lambda _: self.connecting.pop(address, None))
+        return await asyncio.shield(task)
+
+    async def open(self, address):
+        """Opens a connection and negotiates the framed protocol
+
+        Returns None if the handshake goes unanswered, the peer may be an older one or just slow.
+        Raises ConnectionError if the peer closes the connection before answering.
+        """
+        reader, writer = await asyncio.open_connection(*address)
+        writer.write(MAGIC + bytes([Codec.supported_codecs()]))
+        await writer.drain()
+        try:
+            reply = await asyncio.wait_for(reader.readexactly(len(MAGIC) + 1), self.handshake_timeout)
+        except asyncio.TimeoutError:
+            writer.close()
+            return None
+        except asyncio.IncompleteReadError as e:
+            reply = e.partial
+            if not reply or MAGIC.startswith(reply):
+                writer.close()
+                raise ConnectionError("Connection closed during the handshake")
+        if reply[:len(MAGIC)] != MAGIC:
+            # Anything but our preamble is an answer from a peer that doesn't speak the framed protocol
+            writer.close()
+            self.mark_legacy(address)
+            return None
+        connection = PeerConnection(reader, writer, reply[len(MAGIC)], self.metrics, self.max_frame_size)
+        self.connections[address] = connection
+        return connection
+
+    async def one_shot(self, ip, port, message):
+        """Sends a single message on its own connection and reads the response until EOF"""
+        reader, writer = await asyncio.open_connection(ip, port)
+        try:
+            data = json.dumps(message).encode()
+            writer.write(data)
+            writer.write_eof()
+            self.metrics.inc("bytes_sent_total", len(data))
+            self.metrics.inc("messages_sent_total")
+            await writer.drain()
+            line = await reader.read(-1)
+            if line:
+                return json.loads(line.strip().decode())
+        finally:
+            writer.close()
+
+    async def close(self):
+        """Closes every pooled connection"""
+        for connection in list(self.connections.values()):
+            await connection.close()
+        self.connections.clear()
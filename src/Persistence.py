@@ -0,0 +1,171 @@
+import asyncio
+import json
+import os
+import time
+
+
+class Persistence:
+    """Local state stored as a snapshot plus an append-only log of the changes made since
+
+    Posts are kept in the PostStore, post and drop entries are only read from files of older versions.
+    Appends are buffered and written by a background task, off the event loop, once a burst settles
+    for `debounce` seconds or at most `max_delay` seconds after its first entry. `flush` makes them durable now.
+    """
+
+    def __init__(self, path, snapshot, metrics, compact_every=1000, debounce=0.05, max_delay=0.5):
+        self.path = path
+        # Every snapshot starts a new log generation, so a crash mid-compaction never replays stale entries
+        self.generation = 0
+        # Callable returning the full current state, used when compacting
+        self.snapshot = snapshot
+        self.compact_every = compact_every
+        self.log_entries = 0
+        self.metrics = metrics
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.pending = []
+        self.first_pending = None
+        self.last_pending = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+
+    def load(self):
+        """Returns the state in the latest snapshot with the log tail replayed on top"""
+        state = {
+            "subscribers": [],
+            "subscriptions": [],
+            "posts": {},
+            "last_post_id": -1,
+        }
+        if os.path.exists(self.path):
+            with open(self.path) as json_file:
+                info = json.load(json_file)
+            posts = info.get("posts", {})
+            # Older versions stored the posts as a JSON string inside the JSON
+            if isinstance(posts, str):
+                posts = json.loads(posts)
+            state["posts"] = {author: {int(id): post for id, post in author_posts.items()}
+                              for author, author_posts in posts.items()}
+            state["subscribers"] = info["subscribers"]
+            state["subscriptions"] = info["subscriptions"]
+            state["last_post_id"] = info["last_post_id"]
+            self.generation = info.get("generation", 0)
+
+        self.log_entries = 0
+        if os.path.exists(self.log_path):
+            valid_size = 0
+            with open(self.log_path, 'rb') as log_file:
+                for line in log_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+                    if not line.endswith(b"\n"):
+                        break
+                    self.apply(state, entry)
+                    self.log_entries += 1
+                    valid_size += len(line)
+            # Drop a torn write left at the tail by a crash, everything before it is intact
+            if valid_size != os.path.getsize(self.log_path):
+                os.truncate(self.log_path, valid_size)
+        return state
+
+    @property
+    def log_path(self):
+        return f"{self.path}.{self.generation}.log"
+
+    @staticmethod
+    def apply(state, entry):
+        """Applies a log entry to the given state"""
+        operation = entry["op"]
+        if operation == "post":
+            state["posts"].setdefault(entry["author"], {})[int(entry["id"])] = entry["post"]
+        elif operation == "drop":
+            state["posts"].pop(entry["author"], None)
+        elif operation == "set":
+            state[entry["field"]] = entry["value"]
+        elif operation == "add":
+            if entry["key"] not in state[entry["field"]]:
+                state[entry["field"]].append(entry["key"])
+        elif operation == "remove":
+            if entry["key"] in state[entry["field"]]:
+                state[entry["field"]].remove(entry["key"])
+
+    def append(self, *entries):
+        """Queues entries to be appended to the log, writing them right away if there is no event loop"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.write(list(entries), self.snapshot() if self.log_entries + len(entries) >= self.compact_every else None)
+            return
+        now = time.monotonic()
+        if not self.pending:
+            self.first_pending = now
+        self.last_pending = now
+        self.pending.extend(entries)
+        if self.writer is None:
+            self.writer = asyncio.ensure_future(self.run_writer())
+
+    async def run_writer(self):
+        """Flushes the queued entries once they stop coming in, or have waited long enough"""
+        try:
+            while self.pending:
+                wake = min(self.last_pending + self.debounce, self.first_pending + self.max_delay)
+                delay = wake - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                await self.flush()
+        finally:
+            self.writer = None
+
+    async def flush(self):
+        """Durably writes every queued entry, compacting the log once it grows too long"""
+        async with self.lock:
+            if not self.pending:
+                return
+            entries, self.pending = self.pending, []
+            # Taken along with the entries, so the snapshot holds exactly what the log does
+            info = self.snapshot() if self.log_entries + len(entries) >= self.compact_every else None
+            await asyncio.to_thread(self.write, entries, info)
+
+    def write(self, entries, info=None):
+        """Appends entries to the log and fsyncs it, then compacts if given the snapshot to write"""
+        with self.metrics.timer("persistence_write"):
+            with open(self.log_path, 'a') as log_file:
+                for entry in entries:
+                    log_file.write(json.dumps(entry) + "\n")
+                log_file.flush()
+                os.fsync(log_file.fileno())
+            self.log_entries += len(entries)
+        if info is not None:
+            with self.metrics.timer("persistence_compaction"):
+                self.compact(info)
+
+    def compact(self, info=None):
+        """Writes a new snapshot atomically and starts a fresh log"""
+        old_log_path = self.log_path
+        if info is None:
+            info = self.snapshot()
+        info["generation"] = self.generation + 1
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as json_file:
+            json_file.write(json.dumps(info))
+            json_file.flush()
+            os.fsync(json_file.fileno())
+        os.replace(tmp_path, self.path)
+        self.sync_directory()
+        self.generation += 1
+        self.log_entries = 0
+        if os.path.exists(old_log_path):
+            os.remove(old_log_path)
+
+    def sync_directory(self):
+        """Makes the rename of the snapshot durable"""
+        if not hasattr(os, "O_DIRECTORY"):
+            return
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
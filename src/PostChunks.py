@@ -0,0 +1,34 @@
+import json
+
+
+def chunk_key(author, chunk):
+    """DHT key of one of the chunks of an author's posts"""
+    return f"{author}#posts/{chunk}"
+
+
+class PostChunks:
+    """Replicas of an author's signed posts stored in the DHT, bucketed by ranges of ids"""
+
+    def __init__(self, server, fanout, chunk_size=16):
+        self.server = server
+        self.fanout = fanout
+        # Kept small so a chunk fits in a single Kademlia datagram
+        self.chunk_size = chunk_size
+
+    def chunk_of(self, id):
+        """Chunk holding a given post id"""
+        return id // self.chunk_size
+
+    async def store(self, author, chunk, chunk_posts):
+        """Stores one of the chunks of an author, given the {id: post} dict of its posts"""
+        await self.server.set(chunk_key(author, chunk), json.dumps(chunk_posts))
+
+    async def fetch(self, author, ids):
+        """Fetches, in parallel, every chunk holding any of the given ids and returns their posts"""
+        chunks = sorted({self.chunk_of(id) for id in ids})
+        results = await self.fanout.run(chunks, lambda chunk: self.server.get(chunk_key(author, chunk)))
+        posts = {}
+        for value in results.values():
+            if isinstance(value, str):
+                posts.update(json.loads(value))
+        return posts
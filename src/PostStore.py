@@ -0,0 +1,219 @@
+import sqlite3
+import time
+from IdRanges import gaps
+
+# Largest id SQLite can hold, ids claimed by peers are clamped to it
+MAX_ID = 2 ** 63 - 1
+# Most parameters bound in a single query
+BATCH = 500
+
+
+class PostStore:
+    """Posts of every followed author kept in SQLite
+
+    Authors are stored by their compact id from the key registry rather than their PEM.
+    Authors can have a retention policy (keep the last N posts and/or the posts of the last T days).
+    Evicted posts move the author's floor up: ids below it count as held and are never fetched again.
+    """
+
+    def __init__(self, path, keys, keep_posts=None, keep_days=None):
+        self.keys = keys
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS posts (
+                author BLOB NOT NULL,
+                id INTEGER NOT NULL,
+                timestamp REAL NOT NULL,
+                text TEXT NOT NULL,
+                signature TEXT NOT NULL,
+                PRIMARY KEY (author, id)
+            ) WITHOUT ROWID""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS posts_timeline ON posts (timestamp, author, id)")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS authors (
+                author BLOB PRIMARY KEY,
+                floor INTEGER NOT NULL
+            )""")
+        self.connection.commit()
+        # Retention applied to authors without a policy of their own
+        self.default_retention = (keep_posts, keep_days)
+        self.retention = {}
+        self.floors = {keys.pem_of(author): floor
+                       for author, floor in self.connection.execute("SELECT author, floor FROM authors")}
+
+    @staticmethod
+    def to_post(timestamp, text, signature):
+        return {"text": text, "timestamp": timestamp, "signature": signature}
+
+    def floor(self, author):
+        """Lowest id of an author we keep, ids below it were evicted"""
+        return self.floors.get(author, 0)
+
+    def put_many(self, author, posts):
+        """Stores an {id: post} dict and returns the ids that weren't stored before"""
+        author = self.keys.intern(author)
+        floor = self.floor(author)
+        stored = []
+        for id, post in posts.items():
+            if id < floor:
+                continue
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO posts (author, id, timestamp, text, signature) VALUES (?, ?, ?, ?, ?)",
+                (self.keys.id_of(author), id, post["timestamp"], post["text"], post["signature"]))
+            if cursor.rowcount:
+                stored.append(id)
+        if stored:
+            self.enforce_retention(author)
+        self.connection.commit()
+        return stored
+
+    def get(self, author, id):
+        """Returns a post, or None if we don't have it"""
+        row = self.connection.execute("SELECT timestamp, text, signature FROM posts WHERE author = ? AND id = ?",
+                                      (self.keys.id_of(author), id)).fetchone()
+        return None if row is None else self.to_post(*row)
+
+    def count(self, author):
+        """Number of posts we have from an author"""
+        return self.connection.execute("SELECT COUNT(*) FROM posts WHERE author = ?", (self.keys.id_of(author),)).fetchone()[0]
+
+    def last_id(self, author):
+        """Highest id we have from an author, None if we have none"""
+        return self.connection.execute("SELECT MAX(id) FROM posts WHERE author = ?", (self.keys.id_of(author),)).fetchone()[0]
+
+    def unknown_ids(self, author, ids):
+        """Those of the given ids we neither have nor evicted"""
+        floor = self.floor(author)
+        ids = [id for id in ids if floor <= id <= MAX_ID]
+        known = set()
+        for start in range(0, len(ids), BATCH):
+            batch = ids[start:start + BATCH]
+            known.update(id for id, in self.connection.execute(
+                f"SELECT id FROM posts WHERE author = ? AND id IN ({', '.join('?' * len(batch))})",
+                [self.keys.id_of(author)] + batch))
+        return [id for id in ids if id not in known]
+
+    def ranges(self, author):
+        """Ids we hold from an author as ranges, evicted ones included"""
+        floor = self.floor(author)
+        # Consecutive ids share their difference to their rank, so each group of them is a range
+        ranges = [[first, last] for first, last in self.connection.execute(
+            """SELECT MIN(id), MAX(id) FROM (SELECT id, id - ROW_NUMBER() OVER (ORDER BY id) AS island
+               FROM posts WHERE author = ?) GROUP BY island ORDER BY 1""", (self.keys.id_of(author),))]
+        if floor == 0:
+            return ranges
+        if ranges and ranges[0][0] == floor:
+            ranges[0][0] = 0
+            return ranges
+        return [[0, floor - 1]] + ranges
+
+    def misses(self, author, last_id):
+        """Checks whether any id up to last_id is neither held nor evicted, without going through them"""
+        floor = self.floor(author)
+        last_id = min(last_id, MAX_ID)
+        if last_id < floor:
+            return False
+        held = self.connection.execute("SELECT COUNT(*) FROM posts WHERE author = ? AND id BETWEEN ? AND ?",
+                                       (self.keys.id_of(author), floor, last_id)).fetchone()[0]
+        return held < last_id - floor + 1
+
+    def missing_ids(self, author, last_id, limit=None):
+        """Ids up to last_id we neither hold nor evicted from an author, the first `limit` ones if given"""
+        missing = []
+        for first, last in gaps(self.ranges(author), min(last_id, MAX_ID)):
+            if limit is not None:
+                last = min(last, first + limit - len(missing) - 1)
+            missing += range(first, last + 1)
+            if limit is not None and len(missing) >= limit:
+                break
+        return missing
+
+    def range(self, author, first_id=0, last_id=None, limit=None):
+        """Returns the {id: post} dict of an author's posts between two ids, the first `limit` ones if given"""
+        if last_id is None:
+            last_id = MAX_ID
+        rows = self.connection.execute(
+            "SELECT id, timestamp, text, signature FROM posts WHERE author = ? AND id >= ? AND id <= ? ORDER BY id LIMIT ?",
+            (self.keys.id_of(author), first_id, last_id, -1 if limit is None else limit))
+        return {id: self.to_post(*post) for id, *post in rows}
+
+    def missing(self, author, ranges, limit=None, last_id=MAX_ID):
+        """Returns the {id: post} dict of an author's posts up to last_id outside the given ranges, the first `limit` if given
+
+        Only the gaps between the ranges are read, not the posts they cover.
+        """
+        missing = {}
+        for first, last in gaps(sorted(ranges), last_id):
+            missing.update(self.range(author, first, last, None if limit is None else limit - len(missing)))
+            if limit is not None and len(missing) >= limit:
+                break
+        return missing
+
+    def timeline(self, limit=None, before=None, authors=None):
+        """Returns (author, id, post) tuples newest first, only from the given authors if any
+
+        `before` is a (timestamp, author, id) cursor, only posts strictly older than it are returned.
+        """
+        query = "SELECT author, id, timestamp, text, signature FROM posts"
+        conditions = []
+        parameters = []
+        if before is not None:
+            conditions.append("(timestamp, author, id) < (?, ?, ?)")
+            timestamp, author, id = before
+            parameters += [timestamp, self.keys.id_of(author), id]
+        if authors is not None:
+            conditions.append(f"author IN ({', '.join('?' * len(authors))})")
+            parameters += [self.keys.id_of(author) for author in authors]
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY timestamp DESC, author DESC, id DESC LIMIT ?"
+        parameters.append(-1 if limit is None else limit)
+        return [(self.keys.pem_of(author), id, self.to_post(*post))
+                for author, id, *post in self.connection.execute(query, parameters)]
+
+    def newest(self, authors):
+        """Timestamp of the newest post we hold from each of the given authors that we have posts from"""
+        rows = self.connection.execute("SELECT author, MAX(timestamp) FROM posts GROUP BY author")
+        authors = {self.keys.id_of(author): author for author in authors}
+        return {authors[author]: timestamp for author, timestamp in rows if author in authors}
+
+    def drop_author(self, author):
+        """Forgets every post of an author"""
+        self.connection.execute("DELETE FROM posts WHERE author = ?", (self.keys.id_of(author),))
+        self.connection.execute("DELETE FROM authors WHERE author = ?", (self.keys.id_of(author),))
+        self.connection.commit()
+        self.floors.pop(author, None)
+
+    def set_retention(self, author, keep_posts=None, keep_days=None):
+        """Sets how many posts, and from how many days back, are kept from an author (None keeps all)"""
+        self.retention[author] = (keep_posts, keep_days)
+
+    def enforce_retention(self, author):
+        """Evicts the posts of an author beyond its retention policy"""
+        keep_posts, keep_days = self.retention.get(author, self.default_retention)
+        author_id = self.keys.id_of(author)
+        evicted = []
+        if keep_posts is not None:
+            evicted += [id for id, in self.connection.execute(
+                "SELECT id FROM posts WHERE author = ? ORDER BY id DESC LIMIT -1 OFFSET ?", (author_id, keep_posts))]
+        if keep_days is not None:
+            evicted += [id for id, in self.connection.execute(
+                "SELECT id FROM posts WHERE author = ? AND timestamp < ?", (author_id, time.time() - keep_days * 86400))]
+        if not evicted:
+            return
+        floor = max(evicted) + 1
+        self.connection.execute("DELETE FROM posts WHERE author = ? AND id < ?", (author_id, floor))
+        self.connection.execute("INSERT OR REPLACE INTO authors (author, floor) VALUES (?, ?)", (author_id, floor))
+        self.floors[author] = floor
+
+    def sweep(self):
+        """Evicts the posts beyond retention of every author, including those that stopped posting"""
+        for author, in self.connection.execute("SELECT DISTINCT author FROM posts").fetchall():
+            self.enforce_retention(self.keys.pem_of(author))
+        self.connection.commit()
+
+    def close(self):
+        """Closes the database"""
+        self.connection.close()
@@ -1,52 +1,200 @@
-from threading import Thread
 import asyncio
 import json
+import logging
 import time
+from PeerPool import MAGIC, read_frame, write_frame
+from Admission import Admission, EXPENSIVE, claimed_sender
+from Scheduler import PROPAGATION, REPAIR, MAINTENANCE
+from PostStore import MAX_ID
+import Codec
+import Snapshot
 
+log = logging.getLogger(__name__)
 
-class Receiver(Thread):
-    """Receiver class constructor"""
+# Operations with a handler, any other is counted as invalid so peers can't create metric series at will
+OPERATIONS = {"subscribe", "unsubscribe", "request posts", "request missing", "sync", "push", "digest",
+              "snapshot index", "snapshot segment"}
 
-    def __init__(self, user):
-        super().__init__()
-        self.user = user
 
-    def run(self):
-        """Main class function"""
-        listener_loop = asyncio.new_event_loop()
-        listener_loop.run_until_complete(self.serve())
+class Receiver:
+    """Serves the requests of peers to every user hosted by a node"""
 
-    async def serve(self):
-        """Serve function"""
-        server = await asyncio.start_server(self.request_handler, self.user.ip, self.user.receiver_port)
-        await server.serve_forever()
+    def __init__(self, node):
+        self.node = node
+        self.server = None
+        self.writers = set()
+        self.admission = Admission(node.metrics)
+
+    async def start(self):
+        """Starts serving peers on the node's event loop"""
+        self.server = await asyncio.start_server(self.request_handler, self.node.ip, self.node.receiver_port)
+
+    async def stop(self):
+        """Stops serving peers"""
+        if self.server is not None:
+            self.server.close()
+            # Pooled connections stay open until closed here
+            for writer in list(self.writers):
+                writer.close()
+            await self.server.wait_closed()
+            self.server = None
 
     async def request_handler(self, reader, writer):
-        """Redirect each type of operation to its specific handler"""
+        """Serves a framed connection, or a single message from peers using the one-shot protocol"""
+        address = writer.get_extra_info("peername")[0]
+        if not self.admission.accept():
+            await self.refuse(reader, writer)
+            return
+        self.writers.add(writer)
+        sender = None
+        connected = False
         try:
-            line = await reader.read(-1)
+            try:
+                head = await reader.readexactly(len(MAGIC))
+            except asyncio.IncompleteReadError as e:
+                head = e.partial
+
+            if head == MAGIC:
+                codec = Codec.choose_codec((await reader.readexactly(1))[0])
+                writer.write(MAGIC + bytes([codec]))
+                await writer.drain()
+                handlers = set()
+                while True:
+                    try:
+                        message = await read_frame(reader, self.admission.max_message_size, self.admission.idle_timeout)
+                    except asyncio.TimeoutError:
+                        # Idle pooled connections are closed, the peer opens a new one when it needs to
+                        if handlers:
+                            continue
+                        writer.close()
+                        return
+                    if not connected:
+                        sender = claimed_sender(message)
+                        if not self.admission.connect(address, sender):
+                            await self.refuse(reader, writer, codec)
+                            return
+                        connected = True
+                    handler = self.node.spawn(self.frame_handler(writer, message, codec, address))
+                    handlers.add(handler)
+                    handler.add_done_callback(handlers.discard)
 
+            line = head + await self.read_message(reader)
             if line:
                 line = line.strip()
                 line = line.decode()
                 message = json.loads(line)
-
-                operation = message["op"]
-                if operation == "subscribe":
-                    await self.subscribe_handler(writer, message)
-                elif operation == "unsubscribe":
-                    await self.unsubscribe_handler(writer, message)
-                elif operation == "request posts":
-                    await self.request_posts_handler(writer, message)
-                elif operation == "sync":
-                    await self.sync_handler(writer, message)
-                else:
-                    print("Invalid operation")
+                response = await self.handle(message, address)
+                # Older peers don't know busy replies, closing makes them try elsewhere
+                if response is None or response["op"] == "busy":
                     writer.close()
+                else:
+                    await self.write_res(writer, response)
+
+        except asyncio.IncompleteReadError:
+            writer.close()
+        except Exception as e:
+            writer.close()
+            log.warning("Receiver Exception %s", e)
+        finally:
+            self.writers.discard(writer)
+            self.admission.close()
+            if connected:
+                self.admission.disconnect(address, sender)
+
+    async def refuse(self, reader, writer, codec=None):
+        """Closes a connection we can't take, first telling peers speaking the framed protocol we're busy
+
+        They then keep our address and try again later, instead of taking us for offline.
+        """
+        try:
+            if codec is None:
+                head = await asyncio.wait_for(reader.readexactly(len(MAGIC) + 1), self.admission.queue_timeout)
+                if head[:len(MAGIC)] != MAGIC:
+                    return
+                codec = Codec.choose_codec(head[-1])
+                writer.write(MAGIC + bytes([codec]))
+            # Not tied to any request, it refuses the whole connection
+            write_frame(writer, {"op": "busy", "rid": None, "timestamp": time.time()}, codec)
+            await writer.drain()
+        except Exception as e:
+            log.info("Receiver Refusal Exception %s", e)
+        finally:
+            writer.close()
 
+    async def read_message(self, reader):
+        """Reads a one-shot message up to the end of the stream, refusing those over the size limit"""
+        data = b""
+        while chunk := await reader.read(65536):
+            data += chunk
+            if len(data) > self.admission.max_message_size:
+                self.node.metrics.inc("receiver_shed_total", reason="size")
+                raise ValueError(f"Message over {self.admission.max_message_size} bytes")
+        return data
+
+    async def frame_handler(self, writer, message, codec, address):
+        """Handles a framed request and answers it with the same request id"""
+        request_id = message.pop("rid", None)
+        try:
+            response = await self.handle(message, address)
         except Exception as e:
-            print("Receiver Exception " + str(e) +
-                  " in operation " + str(operation))
+            log.warning("Receiver Exception %s in operation %s", e, message.get("op"))
+            response = None
+        if response is None:
+            response = {"op": "error", "sender": message.get("to"), "timestamp": time.time()}
+        response["rid"] = request_id
+        try:
+            write_frame(writer, response, codec)
+            await writer.drain()
+        except Exception as e:
+            log.warning("Receiver Write Exception %s in response %s", e, response.get("op"))
+
+    async def handle(self, message, address):
+        """Redirect each type of operation to its specific handler and returns the response
+
+        Peers over their rate, or expensive operations finding the queue full, get a busy reply instead.
+        """
+        operation = message["op"]
+        label = operation if operation in OPERATIONS else "invalid"
+        self.node.metrics.inc("receiver_requests_total", op=label)
+        user = self.node.route(message)
+        if user is None:
+            log.warning("Operation %s for a user not hosted here", operation)
+            return None
+        if not self.admission.allow(address, claimed_sender(message)):
+            return self.busy(user)
+        if operation not in EXPENSIVE:
+            with self.node.metrics.timer("receiver_handler", op=label):
+                return await self.dispatch(user, operation, message)
+        if not await self.admission.enter():
+            return self.busy(user)
+        try:
+            with self.node.metrics.timer("receiver_handler", op=label):
+                return await self.dispatch(user, operation, message)
+        finally:
+            self.admission.leave()
+
+    async def dispatch(self, user, operation, message):
+        """Calls the handler of an operation"""
+        if operation == "subscribe":
+            return await self.subscribe_handler(user, message)
+        elif operation == "unsubscribe":
+            return await self.unsubscribe_handler(user, message)
+        elif operation == "request posts":
+            return await self.request_posts_handler(user, message)
+        elif operation == "request missing":
+            return await self.request_missing_handler(user, message)
+        elif operation == "sync":
+            return await self.sync_handler(user, message)
+        elif operation == "push":
+            return await self.push_handler(user, message)
+        elif operation == "digest":
+            return await self.digest_handler(user, message)
+        elif operation == "snapshot index":
+            return await self.snapshot_index_handler(user, message)
+        elif operation == "snapshot segment":
+            return await self.snapshot_segment_handler(user, message)
+        log.warning("Invalid operation %s", operation)
+        return None
 
     async def write_res(self, writer, message):
         """Writes the response"""
@@ -60,75 +208,168 @@ class Receiver(Thread):
             return True
         except Exception as e:
             writer.close()
-            print("Receiver Write Exception " +
-                  str(e) + " in response " + str(message))
+            log.warning("Receiver Write Exception %s", e)
             return False
 
-    async def write_ack(self, writer):
-        """Writes an acknowledgement response"""
-        message = {
+    def ack(self, user):
+        """Builds an acknowledgement response"""
+        return {
             "op": "acknowledge",
-            "sender": self.user.public_key,
+            "sender": user.public_key,
             "timestamp": time.time(),
             # "signature": None,
         }
-        return await self.write_res(writer, message)
 
-    async def send_posts(self, writer, target_public_key, first_post=0):
-        """Responds with the requested posts"""
+    def decline(self, user):
+        """Builds the response refusing a push"""
+        return {
+            "op": "decline",
+            "sender": user.public_key,
+            "timestamp": time.time(),
+        }
+
+    def busy(self, user):
+        """Builds the response shedding a request we can't serve now"""
+        return {
+            "op": "busy",
+            "sender": user.public_key,
+            "timestamp": time.time(),
+        }
+
+    def send_posts(self, user, target_public_key, first_post=0):
+        """Builds the response with the requested posts"""
         message = {
             "op": "send posts",
-            "sender": self.user.public_key,
+            "sender": user.public_key,
             "author": target_public_key,
             "first_id": first_post,
             "posts": {},
             "timestamp": time.time(),
             # "signature": None,
         }
-        if target_public_key not in self.user.posts.keys():
-            await self.write_res(writer, message)
-            return
+        # Bounded, older peers get the rest on their next request
+        posts_to_send = self.node.store.range(target_public_key, first_post, limit=self.admission.max_posts_per_reply)
+        if not posts_to_send:
+            return message
 
         try:
-            print("HOWDY")
-            posts_to_send = {key: self.user.posts[target_public_key][key]
-                             for key in self.user.posts[target_public_key] if key >= first_post}
-            print("SENDING: " + str(posts_to_send))
             posts_to_send = json.dumps(posts_to_send)
         except Exception as e:
-            writer.close()
-            print("JSON Exception " + str(e))
+            log.warning("JSON Exception %s", e)
+            return None
 
         message["posts"] = posts_to_send
         # message["signature"] = self.sign(f"{message['op']}:{message['sender']}:{message['author']}:{message['first_id']}:{message['posts']}:{message['timestamp']}")
-        await self.write_res(writer, message)
+        return message
+
+    async def subscribe_handler(self, user, message):
+        """Handles Subscribe messages
 
-    async def subscribe_handler(self, writer, message):
-        """Handles Subscribe messages"""
-        asyncio.run_coroutine_threadsafe(self.user.add_subscriber(
-            message["sender"]), loop=self.user.loop)
-        await self.send_posts(writer, self.user.public_key)
+        Histories too long for a single reply are left for the sender to import as a snapshot, if it can.
+        """
+        sender = message["sender"]
+        user.schedule(MAINTENANCE, lambda: user.add_subscriber(sender), ("subscriber", sender))
+        if message.get("snapshot") and self.node.store.count(user.public_key) > self.admission.max_posts_per_reply:
+            return {
+                "op": "send posts",
+                "sender": user.public_key,
+                "author": user.public_key,
+                "first_id": 0,
+                "posts": {},
+                "snapshot": True,
+                "timestamp": time.time(),
+            }
+        return self.send_posts(user, user.public_key)
 
-    async def unsubscribe_handler(self, writer, message):
+    async def unsubscribe_handler(self, user, message):
         """Handles Unsubscribe messages"""
-        asyncio.run_coroutine_threadsafe(self.user.remove_subscriber(
-            message["sender"]), loop=self.user.loop)
-        await self.write_ack(writer)
+        sender = message["sender"]
+        user.schedule(MAINTENANCE, lambda: user.remove_subscriber(sender), ("subscriber", sender))
+        return self.ack(user)
 
-    async def request_posts_handler(self, writer, message):
+    async def request_posts_handler(self, user, message):
         """Handles Request Post messages"""
-        await self.send_posts(writer, message["target"], message["first_post"])
+        return self.send_posts(user, message["target"], message["first_post"])
 
-    async def sync_handler(self, writer, message):
+    async def request_missing_handler(self, user, message):
+        """Handles Request Missing messages, answering only with the posts the sender doesn't have
+
+        Replies are bounded, `more` tells the sender to ask again for the rest. So is the work done for
+        them: only the first authors are looked at, and for authors with too many ranges only the ids up to
+        the last range kept, the sender having more ranges once it stores what we send.
+        """
+        posts = {}
+        budget = self.admission.max_posts_per_reply
+        have = list(message["have"].items())
+        more = len(have) > self.admission.max_authors_per_request
+        for author, ranges in have[:self.admission.max_authors_per_request]:
+            if budget == 0:
+                more = True
+                break
+            last_id = MAX_ID
+            if len(ranges) > self.admission.max_ranges_per_author:
+                ranges = ranges[:self.admission.max_ranges_per_author]
+                last_id = max(last for first, last in ranges)
+                more = True
+            missing = self.node.store.missing(author, ranges, budget + 1, last_id)
+            if len(missing) > budget:
+                missing = dict(list(missing.items())[:budget])
+                more = True
+            if missing:
+                posts[author] = missing
+            budget -= len(missing)
+        return {
+            "op": "send missing",
+            "sender": user.public_key,
+            "posts": posts,
+            "more": more,
+            "timestamp": time.time(),
+            # "signature": None,
+        }
+
+    async def sync_handler(self, user, message):
         """Handles Sync messages"""
-        await self.write_ack(writer)
-        if message["sender"] in self.user.subscriptions:
-            if message["sender"] in self.user.posts and len(self.user.posts[message["sender"]]) > 0:
-                post_latest_id = int(
-                    max(self.user.posts[message["sender"]].keys()))
-                if int(message["last_post_id"]) > post_latest_id:
-                    asyncio.run_coroutine_threadsafe(self.user.find_posts(
-                        message["sender"], post_latest_id + 1), loop=self.user.loop)
-            else:
-                asyncio.run_coroutine_threadsafe(self.user.find_posts(
-                    message["sender"], 0), loop=self.user.loop)
+        sender = message["sender"]
+        if sender in user.subscriptions and user.misses_posts(sender, int(message["last_post_id"])):
+            # Several syncs from the same author end up in a single search
+            user.schedule(REPAIR, lambda: user.find_posts(sender), ("find_posts", sender))
+        return self.ack(user)
+
+    async def push_handler(self, user, message):
+        """Handles Push messages, declining those we won't relay so the sender picks another head"""
+        author = message["author"]
+        forward = await user.accept_push(author, list(message["forward"]), message["sender"])
+        if forward is None:
+            return self.decline(user)
+        user.schedule(PROPAGATION, lambda: user.receive_push(author, message["posts"], int(message["last_post_id"]), forward))
+        return self.ack(user)
+
+    async def digest_handler(self, user, message):
+        """Handles Digest messages, answering with the buckets that differ from ours"""
+        return {
+            "op": "digest differences",
+            "sender": user.public_key,
+            "differ": user.anti_entropy.differences(message["digests"]),
+            "timestamp": time.time(),
+        }
+
+    async def snapshot_index_handler(self, user, message):
+        """Handles Snapshot Index messages, answering with the segments of an author's posts from an id on"""
+        return {
+            "op": "snapshot index",
+            "sender": user.public_key,
+            "index": Snapshot.export_index(self.node.store, message["author"], int(message["from_id"]),
+                                           min(Snapshot.SEGMENT_SIZE, self.admission.max_posts_per_reply)),
+            "timestamp": time.time(),
+        }
+
+    async def snapshot_segment_handler(self, user, message):
+        """Handles Snapshot Segment messages, answering with the posts of one segment"""
+        return {
+            "op": "snapshot segment",
+            "sender": user.public_key,
+            "author": message["author"],
+            "posts": Snapshot.export_segment(self.node.store, message["author"], int(message["first"]),
+                                             int(message["last"]), self.admission.max_posts_per_reply),
+            "timestamp": time.time(),
+        }
@@ -0,0 +1,132 @@
+import asyncio
+import itertools
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# Priority classes, lower ones run first
+INTERACTIVE = 0
+PROPAGATION = 1
+REPAIR = 2
+MAINTENANCE = 3
+
+
+class Job:
+    """A coroutine factory waiting to be run by the scheduler"""
+
+    def __init__(self, priority, sequence, key, factory, future):
+        self.priority = priority
+        self.sequence = sequence
+        self.key = key
+        self.factory = factory
+        self.future = future
+        self.submitted = time.perf_counter()
+        # Jobs whose key is running are held back until it's done
+        self.held = False
+        # Jobs requeued with a higher priority leave their old entry behind, skipped when popped
+        self.skipped = False
+
+    def __lt__(self, other):
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+
+class Scheduler:
+    """Runs background network jobs on a few workers, the most urgent priority class first
+
+    Jobs submitted with a key are coalesced: submitting a key that is already waiting only refreshes its
+    coroutine factory (raising its priority if needed) and returns the same future. Submitting a key that
+    is running queues it once more, to run when the current one is done, so what changed meanwhile isn't missed.
+    """
+
+    def __init__(self, metrics, workers=8):
+        self.metrics = metrics
+        self.worker_count = workers
+        self.workers = []
+        self.queue = asyncio.PriorityQueue()
+        self.sequence = itertools.count()
+        self.waiting = {}
+        self.running = set()
+
+    def submit(self, priority, factory, key=None):
+        """Schedules factory() to be run and returns a future with its result"""
+        job = self.waiting.get(key) if key is not None else None
+        if job is not None and job.future.cancelled():
+            # Its callers gave up on it, a new job takes its place
+            job.skipped = True
+            del self.waiting[key]
+            job = None
+        if job is not None:
+            self.metrics.inc("scheduler_coalesced_total")
+            job.factory = factory
+            if priority < job.priority:
+                if job.held:
+                    job.priority = priority
+                else:
+                    job.skipped = True
+                    self.enqueue(Job(priority, next(self.sequence), key, factory, job.future))
+            return job.future
+
+        future = asyncio.get_running_loop().create_future()
+        # Nobody may await it, failures are logged by the worker
+        future.add_done_callback(lambda future: future.cancelled() or future.exception())
+        job = Job(priority, next(self.sequence), key, factory, future)
+        if key is not None and key in self.running:
+            job.held = True
+            self.waiting[key] = job
+        else:
+            self.enqueue(job)
+        return future
+
+    def enqueue(self, job):
+        if job.key is not None:
+            self.waiting[job.key] = job
+        self.queue.put_nowait(job)
+
+    def start(self):
+        """Starts the workers"""
+        self.workers = [asyncio.ensure_future(self.work()) for _ in range(self.worker_count)]
+
+    async def stop(self):
+        """Stops the workers, cancelling the jobs still waiting"""
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        for job in self.waiting.values():
+            job.future.cancel()
+        self.waiting.clear()
+
+    async def work(self):
+        """Runs jobs one at a time"""
+        while True:
+            job = await self.queue.get()
+            if job.skipped:
+                continue
+            if job.key is not None:
+                del self.waiting[job.key]
+            if job.future.cancelled():
+                continue
+            if job.key is not None:
+                self.running.add(job.key)
+            self.metrics.observe("scheduler_wait_seconds", time.perf_counter() - job.submitted, priority=job.priority)
+            self.metrics.inc("scheduler_jobs_total", priority=job.priority)
+            # Whoever awaited the future may have been cancelled meanwhile, cancelling it too
+            try:
+                result = await job.factory()
+                if not job.future.done():
+                    job.future.set_result(result)
+            except asyncio.CancelledError:
+                job.future.cancel()
+                raise
+            except Exception as e:
+                log.warning("Scheduled job Exception %s", e)
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                if job.key is not None:
+                    self.running.discard(job.key)
+                    held = self.waiting.get(job.key)
+                    if held is not None and held.held:
+                        held.held = False
+                        self.queue.put_nowait(held)
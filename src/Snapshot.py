@@ -0,0 +1,49 @@
+import hashlib
+import json
+
+# Bumped whenever the index or segments change shape
+FORMAT = 1
+# Posts per segment, at most as many as a reply may carry
+SEGMENT_SIZE = 256
+
+
+def segment_hash(posts):
+    """Hash of a segment's {id: post} dict, the same whatever codec carried it"""
+    content = [[int(id), post["text"], post["timestamp"], post["signature"]]
+               for id, post in sorted(posts.items(), key=lambda item: int(item[0]))]
+    return hashlib.blake2b(json.dumps(content).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def resume_point(ranges):
+    """First id missing from the start of the ids held, given as ranges"""
+    if ranges and ranges[0][0] == 0:
+        return ranges[0][1] + 1
+    return 0
+
+
+def export_index(store, author, from_id=0, segment_size=SEGMENT_SIZE):
+    """Index of an author's posts from an id on, split in segments of up to segment_size posts
+
+    Reads one segment at a time, so memory stays bounded whatever the length of the history.
+    """
+    segments = []
+    first = from_id
+    while True:
+        posts = store.range(author, first, limit=segment_size)
+        if not posts:
+            break
+        ids = list(posts)
+        segments.append({"first": ids[0], "last": ids[-1], "count": len(ids), "hash": segment_hash(posts)})
+        first = ids[-1] + 1
+    return {
+        "format": FORMAT,
+        "author": author,
+        "from_id": from_id,
+        "segment_size": segment_size,
+        "segments": segments,
+    }
+
+
+def export_segment(store, author, first, last, segment_size=SEGMENT_SIZE):
+    """Posts of one segment, never more than segment_size"""
+    return store.range(author, first, last, limit=segment_size)
@@ -0,0 +1,185 @@
+import base64
+import hashlib
+import json
+import random
+import time
+from kademlia.storage import ForgetfulStorage
+from Codec import pem_to_raw, raw_to_pem
+
+# Tombstones only need to outlive the stale copies of the adds they cancel
+TOMBSTONE_TTL = 7 * 24 * 3600
+
+
+def shard_key(owner, shard):
+    """DHT key of one of the shards of an owner's subscriber set"""
+    return f"{owner}#subscribers/{shard}"
+
+
+def encode_member(public_key):
+    """Stores Ed25519 keys as the base64 of their raw bytes instead of the whole PEM"""
+    raw = pem_to_raw(public_key)
+    return public_key if raw is None else base64.b64encode(raw).decode('utf-8')
+
+
+def decode_member(member):
+    """Inverse of encode_member"""
+    return member if member.startswith("-----") else raw_to_pem(base64.b64decode(member))
+
+
+def merge(record, other):
+    """Merges two last-writer-wins sets, each mapping members to the time they were added or removed"""
+    merged = {"add": dict(record["add"]), "remove": dict(record["remove"])}
+    for field in ("add", "remove"):
+        for member, timestamp in other[field].items():
+            if timestamp > merged[field].get(member, float("-inf")):
+                merged[field][member] = timestamp
+    # Once split, a shard stays split
+    if record.get("split") or other.get("split"):
+        merged["split"] = True
+    return merged
+
+
+def prune(record, tombstone_ttl=TOMBSTONE_TTL, now=None):
+    """Drops the adds cancelled by a later remove, and the tombstones older than tombstone_ttl"""
+    now = time.time() if now is None else now
+    pruned = dict(record)
+    pruned["add"] = {member: timestamp for member, timestamp in record["add"].items()
+                     if timestamp > record["remove"].get(member, float("-inf"))}
+    pruned["remove"] = {member: timestamp for member, timestamp in record["remove"].items()
+                        if member not in pruned["add"] and now - timestamp < tombstone_ttl}
+    return pruned
+
+
+def members(record):
+    """Members of a last-writer-wins set"""
+    return [decode_member(member) for member, timestamp in record["add"].items()
+            if timestamp > record["remove"].get(member, float("-inf"))]
+
+
+def parse_record(value):
+    """The shard record held in a DHT value, None if it isn't one"""
+    try:
+        record = json.loads(value)
+    except (TypeError, ValueError):
+        return None
+    if isinstance(record, dict) and isinstance(record.get("add"), dict) and isinstance(record.get("remove"), dict):
+        return record
+    return None
+
+
+class MergingStorage(ForgetfulStorage):
+    """DHT storage merging the shard records stored under the same key instead of keeping the last one
+
+    Two subscribers writing the same shard at once each send the record they read plus their own change,
+    so keeping only the last write would lose the other's. Merged records are pruned like written ones, so
+    cancelled adds and expired tombstones don't come back from the stored copy. Any other value is
+    replaced as usual.
+    """
+
+    def __init__(self, ttl=604800, tombstone_ttl=TOMBSTONE_TTL):
+        super().__init__(ttl)
+        self.tombstone_ttl = tombstone_ttl
+
+    def __setitem__(self, key, value):
+        current = parse_record(self.get(key))
+        record = parse_record(value) if current is not None else None
+        if record is not None:
+            value = json.dumps(prune(merge(current, record), self.tombstone_ttl))
+        super().__setitem__(key, value)
+
+
+class SubscriberShards:
+    """Subscriber sets split across hash-bucketed DHT records with mergeable add/remove
+
+    A shard holds at most `capacity` members and tombstones, so it fits in a single Kademlia datagram.
+    A full shard is marked split and members that don't fit go down to one of its `fanout` children,
+    picked by their hash like the shard itself, growing a tree of bounded records.
+    """
+
+    def __init__(self, server, fanout, shards=16, tombstone_ttl=TOMBSTONE_TTL, capacity=64, children=16,
+                 max_depth=8):
+        self.server = server
+        self.fanout = fanout
+        # Number of shards used for this node's own subscriber set, published in its DHT record
+        self.shards = shards
+        self.tombstone_ttl = tombstone_ttl
+        self.capacity = capacity
+        self.children = children
+        self.max_depth = max_depth
+
+    @staticmethod
+    def hash_of(subscriber):
+        return int(hashlib.sha1(subscriber.encode('utf-8')).hexdigest(), 16)
+
+    @staticmethod
+    def shard_of(subscriber, shards):
+        """Top level shard holding a given subscriber"""
+        return SubscriberShards.hash_of(subscriber) % shards
+
+    def path_of(self, subscriber, shards):
+        """Shards a subscriber may be found in, from its top level shard down to the deepest child"""
+        digits = self.hash_of(subscriber) // shards
+        shard = str(self.shard_of(subscriber, shards))
+        path = [shard]
+        for _ in range(self.max_depth):
+            shard = f"{shard}.{digits % self.children}"
+            digits //= self.children
+            path.append(shard)
+        return path
+
+    async def get_shard(self, owner, shard):
+        """Fetches one shard, empty if it was never written"""
+        value = await self.server.get(shard_key(owner, shard))
+        if value is None:
+            return {"add": {}, "remove": {}}
+        return json.loads(value)
+
+    async def update(self, owner, shards, subscriber, field):
+        """Records an add or remove of a subscriber in the shard holding it, or the first one along its path with room"""
+        member = encode_member(subscriber)
+        now = time.time()
+        for depth, shard in enumerate(self.path_of(subscriber, shards)):
+            record = await self.get_shard(owner, shard)
+            held = member in record["add"] or member in record["remove"]
+            last = depth == self.max_depth
+            if not held and record.get("split") and not last:
+                continue
+            if not held and field == "remove":
+                # Never added here, nor below as this shard was never split
+                return
+            if not held and len(record["add"]) + len(record["remove"]) >= self.capacity and not last:
+                record["split"] = True
+                await self.server.set(shard_key(owner, shard), json.dumps(record))
+                continue
+            record = prune(merge(record, {"add": {}, "remove": {}, field: {member: now}}), self.tombstone_ttl, now)
+            await self.server.set(shard_key(owner, shard), json.dumps(record))
+            return
+
+    async def add(self, owner, shards, subscriber):
+        """Adds a subscriber to the owner's subscriber set"""
+        await self.update(owner, shards, subscriber, "add")
+
+    async def remove(self, owner, shards, subscriber):
+        """Removes a subscriber from the owner's subscriber set"""
+        await self.update(owner, shards, subscriber, "remove")
+
+    async def members(self, owner, shards, sample=None):
+        """Fetches the owner's subscribers, from every shard or only from a random sample of the top level ones
+
+        The children of split shards are fetched level by level. Returns None if any shard couldn't be fetched.
+        """
+        level = [str(shard) for shard in range(shards)]
+        if sample is not None and sample < shards:
+            level = random.sample(level, sample)
+        subscribers = []
+        while level:
+            results = await self.fanout.run(level, lambda shard: self.get_shard(owner, shard))
+            next_level = []
+            for shard, record in results.items():
+                if not isinstance(record, dict):
+                    return None
+                subscribers.extend(members(record))
+                if record.get("split") and shard.count(".") < self.max_depth:
+                    next_level += [f"{shard}.{child}" for child in range(self.children)]
+            level = next_level
+        return sorted(set(subscribers))
@@ -1,36 +1,47 @@
-from fastapi import FastAPI, Body, HTTPException
+from fastapi import APIRouter, FastAPI, Body, Depends, HTTPException, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from cryptography.hazmat.primitives.serialization import load_pem_private_key
 from User import User
+from Node import Node
 import time
 from datetime import datetime
 from fastapi.middleware.cors import CORSMiddleware
 import os
+import json
 from dotenv import load_dotenv
 
-import nest_asyncio
-nest_asyncio.apply()
-
 load_dotenv("users/david.env")
 
+# Several identities can share the node, listed comma separated in the same order in both variables
 USER_PRIVATE_KEY_FILE = os.getenv('USER_PRIVATE_KEY_FILE')
 KADEMLIA_PORT = os.getenv('KADEMLIA_PORT')
 RECEIVER_PORT = os.getenv('RECEIVER_PORT')
 USER_FILE = os.getenv('USER_FILE')
-
-with open(USER_PRIVATE_KEY_FILE, "rb") as f:
-    user_private_key = load_pem_private_key(f.read(), password=None)
+STORE_FILE = os.getenv('STORE_FILE', os.path.splitext(USER_FILE.split(",")[0])[0] + ".db")
 
 
 import logging
-log = logging.getLogger('kademlia')
-log.setLevel(logging.DEBUG)
-log.addHandler(logging.StreamHandler())
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'WARNING'))
 
-# Create the User
-user = User(user_private_key, "127.0.0.1", int(KADEMLIA_PORT),int(RECEIVER_PORT), [("127.0.0.1", 6000)], USER_FILE)
+# Create the Node and its Users
+node = Node("127.0.0.1", int(KADEMLIA_PORT), int(RECEIVER_PORT), [("127.0.0.1", 6000)], STORE_FILE, tracing=os.getenv('TRACING') == '1')
+for key_file, user_file in zip(USER_PRIVATE_KEY_FILE.split(","), USER_FILE.split(",")):
+    with open(key_file, "rb") as f:
+        User(load_pem_private_key(f.read(), password=None), persistence_file=user_file, node=node)
 
 app = FastAPI()
 
+
+@app.on_event("startup")
+async def startup():
+    await node.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await node.stop()
+
+
 origins = [
     "http://localhost:3000/",
 ]
@@ -41,6 +52,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Before-Ts", "X-Next-After-Id"],
 )
 
 posts = [
@@ -74,7 +86,13 @@ posts = [
     }
 ]
 
-aliases = {"MCowBQYDK2VwAyEAwM3fp+hoAaYhnxcd4KaP0ngUAVSqbYiHWFz0ralaAVs=": "Zé"}
+# Aliases each hosted user gave to the authors they follow, by public key
+aliases = {node.default_user.public_key: {"MCowBQYDK2VwAyEAwM3fp+hoAaYhnxcd4KaP0ngUAVSqbYiHWFz0ralaAVs=": "Zé"}}
+
+
+def aliases_of(user):
+    """Aliases set by a user, other users on the node don't see them"""
+    return aliases.setdefault(user.public_key, {})
 
 
 @app.get("/")   
@@ -82,89 +100,171 @@ async def root():
     return {"message": "Hello World"}
 
 
-@app.get("/timeline")
-async def get_timeline():
-    posts = user.get_posts()
-    print("POSTS: " + str(posts))
-    # Transform the timestamp in each post to a date format
-    transformed_posts = []
-    for post in posts:
-        # Convert the timestamp to a date
-        date = datetime.fromtimestamp(post["timestamp"])
-        # Format the date in the desired format
-        formatted_date = date.strftime("%Y-%m-%d %H:%M:%S")
+def current_user(request: Request):
+    """User a request is scoped to, the first one configured unless under /users/<id>"""
+    user_id = request.path_params.get("user_id")
+    if user_id is None:
+        return node.default_user
+    # Ids are the URL safe version of the short public key
+    user = node.users.get(to_pem(user_id.replace("-", "+").replace("_", "/")))
+    if user is None:
+        raise HTTPException(status_code=404, detail="Unknown user")
+    return user
+
+
+router = APIRouter()
+
+
+@app.get("/users")
+async def get_users():
+    res = []
+    for public_key in node.users:
+        pubkey = node.keys.short(public_key)
+        res.append({"pubkey": pubkey, "id": pubkey.replace("+", "-").replace("/", "_")})
+    return res
+
+
+PAGE_SIZE = 100
+# Pages asked for with a bigger limit are cut to this size, streaming has no such bound
+MAX_PAGE_SIZE = 1000
 
-        # Create a new post with the formatted date
-        transformed_post = post
-        post["formatted_date"] = formatted_date
 
-        post["author"] = post["author"][27:87]
+def to_pem(pubkey):
+    """Rebuilds a PEM public key from its base64 body"""
+    try:
+        return node.keys.from_short(pubkey)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid public key")
 
-        if (post["author"] in aliases.keys()):
-            post["author_alias"] = aliases[post["author"]]
-        else:
-            post["author_alias"] = ""
 
-        transformed_posts.append(transformed_post)
-    return transformed_posts
+def transform_post(post, user):
+    """Formats a post for the frontend, with the author's alias as set by the user"""
+    # Convert the timestamp to a date in the desired format
+    post["formatted_date"] = datetime.fromtimestamp(post["timestamp"]).strftime("%Y-%m-%d %H:%M:%S")
+    post["author"] = node.keys.short(post["author"])
+    post["author_alias"] = aliases_of(user).get(post["author"], "")
+    return post
 
 
-@app.get("/pubkey")
-async def get_public_key():
-    pubkey = user.public_key[27:87]
+def parse_cursor(before_ts, after_id):
+    """Builds a timeline cursor from the timestamp and "<pubkey>:<id>" of the last post seen"""
+    if before_ts is None:
+        return None
+    if after_id == "":
+        return (before_ts, "", -1)
+    pubkey, _, id = after_id.rpartition(":")
+    if pubkey == "" or not id.isnumeric():
+        raise HTTPException(status_code=400, detail="Invalid after_id")
+    return (before_ts, to_pem(pubkey), int(id))
+
+
+def next_cursor(post):
+    """Cursor pointing right after the given (already transformed) post"""
+    return post["timestamp"], f"{post['author']}:{post['id']}"
+
+
+async def stream_timeline(user, limit, cursor):
+    """Yields the timeline as NDJSON, one page at a time
+
+    Asynchronous so pages are read on the event loop, where the post store lives, and not in a worker thread.
+    """
+    remaining = limit
+    while remaining is None or remaining > 0:
+        page_size = PAGE_SIZE if remaining is None else min(PAGE_SIZE, remaining)
+        posts = user.get_posts(page_size, cursor)
+        if not posts:
+            break
+        cursor = (posts[-1]["timestamp"], posts[-1]["author"], posts[-1]["id"])
+        for post in posts:
+            yield json.dumps(transform_post(post, user)) + "\n"
+        if remaining is not None:
+            remaining -= len(posts)
+
+
+@router.get("/timeline")
+async def get_timeline(response: Response, limit: int = None, before_ts: float = None, after_id: str = "", stream: bool = False, user: User = Depends(current_user)):
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail="Invalid limit")
+    cursor = parse_cursor(before_ts, after_id)
+    # Streams the whole timeline unless limited, pages default to PAGE_SIZE posts
+    if stream:
+        return StreamingResponse(stream_timeline(user, limit, cursor), media_type="application/x-ndjson")
+
+    limit = min(limit or PAGE_SIZE, MAX_PAGE_SIZE)
+    posts = [transform_post(post, user) for post in user.get_posts(limit, cursor)]
+    if len(posts) == limit:
+        response.headers["X-Next-Before-Ts"], response.headers["X-Next-After-Id"] = map(str, next_cursor(posts[-1]))
+    return posts
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return node.metrics.render()
+
+
+@router.get("/status")
+async def get_status(user: User = Depends(current_user)):
+    # Startup goes on in the background, the timeline is served from local state meanwhile
+    return dict(user.progress, bootstrapped=node.bootstrapped.is_set())
+
+
+@router.get("/pubkey")
+async def get_public_key(user: User = Depends(current_user)):
+    pubkey = node.keys.short(user.public_key)
     return {"pubkey": pubkey}
 
 
-@app.get("/subscriptions")
-async def get_subscriptions():
-    subscribers = user.subscriptions
+@router.get("/subscriptions")
+async def get_subscriptions(user: User = Depends(current_user)):
+    subscribers = sorted(user.subscriptions)
     res = []
     for subscriber in subscribers:
-        pub_key = subscriber[27:87]
-        sub = {"pubkey": pub_key, "alias": ""}
-        if pub_key in aliases.keys():
-            sub["alias"] = aliases[pub_key]
+        pub_key = node.keys.short(subscriber)
+        sub = {"pubkey": pub_key, "alias": aliases_of(user).get(pub_key, "")}
         res.append(sub)
 
     return res
 
 
-@app.get("/subscribed")
-async def get_subscribed():
-    subscribers = user.subscribers
+@router.get("/subscribed")
+async def get_subscribed(user: User = Depends(current_user)):
+    subscribers = sorted(user.subscribers)
     res = []
     for subscriber in subscribers:
-        pub_key = subscriber[27:87]
+        pub_key = node.keys.short(subscriber)
         res.append({"pubkey": pub_key})
 
     return res
 
 
-@app.get("/subscribe")
-async def add_subscription(pubkey: str = "", alias: str = ""):
+@router.get("/subscribe")
+async def add_subscription(pubkey: str = "", alias: str = "", user: User = Depends(current_user)):
     if (pubkey == ""):
         raise HTTPException(status_code=400, detail="Missing public key")
-    pubkey_ = "-----BEGIN PUBLIC KEY-----\n" + \
-        pubkey + "\n-----END PUBLIC KEY-----\n"
-    res_code, res_string = user.loop.run_until_complete(user.subscribe(pubkey_))
+    pubkey_ = to_pem(pubkey)
+    res_code, res_string = await user.subscribe(pubkey_)
     if res_code != -2 and alias != "":
-        aliases[pubkey] = alias
+        aliases_of(user)[pubkey] = alias
     return {"detail": res_string}
 
 
-@app.get("/unsubscribe")
-async def remove_subscription(pubkey: str = ""):
+@router.get("/unsubscribe")
+async def remove_subscription(pubkey: str = "", user: User = Depends(current_user)):
     if (pubkey == ""):
         raise HTTPException(status_code=400, detail="Missing public key")
-    pubkey_ = "-----BEGIN PUBLIC KEY-----\n" + \
-        pubkey + "\n-----END PUBLIC KEY-----\n"
-    res_code, res_string = user.loop.run_until_complete(user.unsubscribe(pubkey_))
+    pubkey_ = to_pem(pubkey)
+    res_code, res_string = await user.unsubscribe(pubkey_)
     return {"detail": res_string}
 
 
-@app.post("/post")
-async def add_post(text: str = Body()):
+@router.post("/post")
+async def add_post(text: str = Body(), user: User = Depends(current_user)):
     if (text == ""):
         raise HTTPException(status_code=400, detail="Missing post text")
-    user.loop.run_until_complete(user.create_post(text))
+    await user.create_post(text)
     return {"detail": "Posted successfully!"}
+
+
+app.include_router(router)
+# Every identity on the node has the same API under its own prefix
+app.include_router(router, prefix="/users/{user_id}")
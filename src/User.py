@@ -2,122 +2,237 @@ import time
 import json
 import asyncio
 import base64
+import logging
 import os
 from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
 from cryptography.hazmat.primitives import serialization
-from kademlia.network import Server
-from Receiver import Receiver
+from Persistence import Persistence
+from Node import Node
+from AntiEntropy import AntiEntropy
+from Scheduler import INTERACTIVE, PROPAGATION, REPAIR, MAINTENANCE
+from Verifier import load_public_key
+import Snapshot
+
+log = logging.getLogger(__name__)
 
 
 class User:
-    def __init__(self, private_key, ip, kademlia_port, receiver_port, bootstrap_nodes=[], persistence_file="data.json"):
-        """User class constructor"""
-        # Event loop for io operations
-        self.loop = asyncio.get_event_loop()
+    def __init__(self, private_key, ip=None, kademlia_port=None, receiver_port=None, bootstrap_nodes=[], persistence_file="data.json", fanout_limit=16, peer_timeout=5, verify_executor="thread", propagation="gossip", gossip_fanout=4, subscriber_shards=16, dht_replication=False, hedge_width=3, tracing=False, keep_posts=None, keep_days=None, anti_entropy_interval=60, node=None):
+        """User class constructor
 
+        Users given a node share its dht server, receiver, pool and post store with the other users on it,
+        otherwise they get a node of their own, built from the networking and storage arguments.
+        """
         self.private_key = private_key
-        self.ip = ip
-        self.receiver_port = receiver_port
-        self.server = Server()
-        self.receiver = Receiver(self)
-        self.subscriptions = []
-        self.subscribers = []
+        self.owns_node = node is None
+        if node is None:
+            node = Node(ip, kademlia_port, receiver_port, bootstrap_nodes, os.path.splitext(persistence_file)[0] + ".db",
+                        fanout_limit, peer_timeout, verify_executor, subscriber_shards, tracing, keep_posts, keep_days)
+        self.node = node
+        self.ip = node.ip
+        self.kademlia_port = node.kademlia_port
+        self.receiver_port = node.receiver_port
+        self.bootstrap_nodes = node.bootstrap_nodes
+        self.metrics = node.metrics
+        self.server = node.server
+        self.dht = node.dht
+        self.peers = node.peers
+        self.receiver = node.receiver
+        self.fanout = node.fanout
+        # How many subscribers are asked at once when the author can't be reached
+        self.hedge_width = hedge_width
+        self.shards = node.shards
+        # Whether our posts are also replicated in the dht and looked up there when authors are offline
+        self.dht_replication = dht_replication
+        self.chunks = node.chunks
+        self.pool = node.pool
+        self.verifier = node.verifier
+        # How new posts reach subscribers: "sync" pings, direct "push" or a "gossip" tree
+        self.propagation = propagation
+        self.gossip_fanout = gossip_fanout
+        # Most peers a relayed push may ask us to pass it on to
+        self.max_forward = 1024
+        # Most authors asked for in a single request missing, as peers only look at so many
+        self.max_authors_per_request = 64
+        # Posting reads the subscriber set from the DHT at most this often, in seconds
+        self.subscribers_max_age = 60
+        self.subscribers_read = float("-inf")
+        # Seconds between reconciliations with other subscribers of the same authors, None disables them
+        self.anti_entropy = AntiEntropy(self, anti_entropy_interval)
+        # Background tasks spawned by the user, kept so they aren't garbage collected mid-run
+        self.tasks = set()
+        self.joining = None
+        self.progress = {"stage": "starting", "authors": 0, "authors_done": 0}
+        # Every key we keep is interned here, subscriptions and subscribers are sets of interned keys
+        self.keys = node.keys
+        self.subscriptions = set()
+        self.subscribers = set()
         self.last_post_id = -1
-        self.posts = {}
         self.persistence_file = persistence_file
+        self.persistence = Persistence(persistence_file, self.get_local_info, self.metrics)
+        self.store = node.store
+
+        # Extract the public key from the private key
+        self.public_key = self.keys.intern(self.serialize_key(self.private_key.public_key()))
 
         self.load_local_info()
+        node.register(self)
 
-        self.loop.run_until_complete(self.server.listen(kademlia_port))
-        self.loop.run_until_complete(self.server.bootstrap([(self.ip, kademlia_port)]))
-        for node in bootstrap_nodes:
-            print("Bootstraping with: " + str(node))
-            self.loop.run_until_complete(self.server.bootstrap([(node[0], node[1])]))
+    async def start(self):
+        """Starts serving from the local state right away, joining the network and catching up in the background"""
+        if self.node.started:
+            self.join_in_background()
+        else:
+            await self.node.start()
+
+    def join_in_background(self):
+        """Starts catching up, unless already doing it"""
+        if self.joining is None:
+            self.joining = self.spawn(self.join())
+        return self.joining
+
+    async def join(self):
+        """Catches up with the subscriptions once the node is in the network, reporting progress in `progress`"""
+        self.progress["stage"] = "bootstrap"
+        await self.node.bootstrapped.wait()
 
-        # Extract the public key from the private key
-        self.public_key = self.serialize_key(self.private_key.public_key())
-        
         # Update state using the data on the DHT
-        dht_info = self.loop.run_until_complete(
-            self.server.get(self.public_key))
-        if dht_info != None:
-            dht_info = json.loads(dht_info)
-            self.subscribers = dht_info["subscribers"]
-
-        self.loop.run_until_complete(self.update_timeline())
-        self.loop.run_until_complete(self.sync_subs())
-        self.loop.run_until_complete(self.update_info())
-
-        self.receiver.daemon = True
-        self.receiver.start()
-    
-    async def update_subscribers(self):
-        """Updates subscribers using dht data"""
-        dht_info = await self.server.get(self.public_key)
-        if dht_info != None:
-            dht_info = json.loads(dht_info)
-            self.subscribers = dht_info["subscribers"]
+        self.progress["stage"] = "subscribers"
+        await self.migrate_subscribers()
+        await self.update_subscribers()
+
+        self.progress["stage"] = "timeline"
+        await self.update_timeline()
+        self.progress["stage"] = "sync"
+        await self.sync_subs()
+        await self.update_info()
+        self.progress["stage"] = "ready"
+
+        if self.anti_entropy.interval is not None:
+            self.spawn(self.anti_entropy.run())
+
+    async def stop(self):
+        """Stops serving peers and leaves the network, along with the node if it's our own"""
+        if self.owns_node:
+            await self.node.stop()
+        else:
+            await self.leave()
+
+    async def leave(self):
+        """Writes the pending state and stops the background tasks"""
+        await self.persistence.flush()
+        for task in list(self.tasks):
+            task.cancel()
+
+    def schedule(self, priority, factory, key=None):
+        """Runs factory() in the node's scheduler, coalescing it with our other jobs of the same key"""
+        return self.node.scheduler.submit(priority, factory, None if key is None else (self.public_key,) + key)
+
+    def spawn(self, coroutine):
+        """Runs a coroutine in the background"""
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def update_subscribers(self, max_age=None):
+        """Updates subscribers using the sharded subscriber set in the dht, unless read less than max_age seconds ago
+
+        Subscribes and unsubscribes sent to us update the set meanwhile, the DHT only adds those made while we were away.
+        """
+        if max_age is not None and time.monotonic() - self.subscribers_read < max_age:
             return self.subscribers
-        return []
-    
+        subscribers = await self.shards.members(self.public_key, self.shards.shards)
+        # Keep the ones we know of if some shard couldn't be read
+        if subscribers is not None:
+            self.subscribers_read = time.monotonic()
+            self.set_subscribers({self.keys.intern(sub) for sub in subscribers})
+        return self.subscribers
+
+    async def migrate_subscribers(self):
+        """Moves the subscriber list of a record written by an older version into the shards"""
+        dht_info = await self.dht.get(self.public_key)
+        if dht_info is None:
+            return
+        subscribers = json.loads(dht_info).get("subscribers", [])
+        await self.fanout.run(subscribers, lambda sub: self.shards.add(self.public_key, self.shards.shards, sub))
+
+    async def subscribers_of(self, public_key, sample=4):
+        """Fetches some of the subscribers of another user, None if the user is unknown"""
+        peer_info = await self.peers.get(public_key)
+        if peer_info is None:
+            return None
+        # Records of older peers hold the whole subscriber list
+        subscribers = list(peer_info.get("subscribers", []))
+        if "subscriber_shards" in peer_info:
+            subscribers += await self.shards.members(public_key, peer_info["subscriber_shards"], sample) or []
+        return subscribers
+
     async def update_info(self):
-        """Updates both local and dht data with the current state"""
-        self.update_local_info()
+        """Updates dht data with the current state, local data is logged as it changes"""
         await self.update_dht()
 
-    def update_local_info(self):
-        """Updates local data with the current state"""
-        with open(self.persistence_file, 'w') as json_file:
-            info = {
-            "subscribers": self.subscribers,
-            "subscriptions": self.subscriptions,
-            "posts": json.dumps(self.posts),
+    def set_subscribers(self, subscribers):
+        """Replaces the subscribers list, logging it if it changed"""
+        if subscribers != self.subscribers:
+            self.subscribers = subscribers
+            self.persistence.append({"op": "set", "field": "subscribers", "value": sorted(subscribers)})
+
+    def get_local_info(self):
+        """Returns the full local state to be snapshotted"""
+        return {
+            "subscribers": sorted(self.subscribers),
+            "subscriptions": sorted(self.subscriptions),
             "last_post_id": self.last_post_id,
         }
-            json_file.write(json.dumps(info))
 
     def load_local_info(self):
         """Fetches local data and updates current state"""
-        if not os.path.exists(self.persistence_file):
-            return
-
-        with open(self.persistence_file) as json_file:
-            try:
-                info = json.load(json_file)
-                self.subscribers = info["subscribers"]
-                self.subscriptions = info["subscriptions"]
-                loaded_posts = json.loads(info["posts"])
-                for key in loaded_posts:
-                    loaded_posts[key] = {int(k): v if k.isnumeric() else k for k, v in loaded_posts[key].items()}
-                self.posts = loaded_posts
-                self.last_post_id = info["last_post_id"]
-            except Exception as e:
-                print("Local Persistence Exception " + str(e))
+        try:
+            info = self.persistence.load()
+            self.subscribers = {self.keys.intern(sub) for sub in info["subscribers"]}
+            self.subscriptions = {self.keys.intern(sub) for sub in info["subscriptions"]}
+            self.last_post_id = info["last_post_id"]
+            # Posts kept by older versions in the snapshot and log are moved to the store
+            if info["posts"]:
+                for author, posts in info["posts"].items():
+                    self.store.put_many(author, posts)
+                self.persistence.compact()
+        except Exception as e:
+            log.error("Local Persistence Exception %s", e)
+        # Stores written by older versions may hold posts whose id never reached the log
+        last_stored = self.store.last_id(self.public_key)
+        if last_stored is not None:
+            self.last_post_id = max(self.last_post_id, last_stored)
 
     async def update_dht(self):
         """Updates dht data with current state"""
-        await self.server.set(self.public_key, json.dumps(self.get_dht_info()))
+        await self.node.bootstrapped.wait()
+        await self.dht.set(self.public_key, json.dumps(self.get_dht_info()))
 
     def get_dht_info(self):
         """Fetches dht data and updates current state"""
         return {
             "ip": self.ip,
             "port": self.receiver_port,
-            "subscriptions": self.subscriptions,
-            "subscribers": self.subscribers,
+            "subscriptions": sorted(self.subscriptions),
+            "subscriber_shards": self.shards.shards,
             "last_post_id": self.last_post_id,
         }
 
-    def get_posts(self):
-        """Returns a list with the user's posts sorted by the timestamp"""
+    def get_posts(self, limit=None, before=None):
+        """Returns a list with the user's posts sorted by the timestamp, newest first
+
+        `before` is a (timestamp, author, id) cursor, only posts older than it are returned.
+        """
         res_posts = []
-        for author in self.posts.keys():
-            for id in self.posts[author].keys():
-                full_post = self.posts[author][id]
-                full_post["author"] = author
-                full_post["id"] = id
-                res_posts.append(full_post)
-        res_posts.sort(key=lambda post: post["timestamp"], reverse=True)
+        # The store is shared with the other users on the node
+        authors = self.subscriptions | {self.public_key}
+        for author, id, post in self.store.timeline(limit, before, authors):
+            full_post = dict(post)
+            full_post["author"] = author
+            full_post["id"] = id
+            res_posts.append(full_post)
         return res_posts
 
     def serialize_key(self, public_key):
@@ -127,9 +242,9 @@ class User:
     def deserialize_key(self, public_key):
         """Deserializes public key"""
         try:
-            return serialization.load_pem_public_key(public_key.encode('utf-8'))
+            return load_public_key(public_key)
         except Exception as e:
-            print("Deserialize Exception " + str(e))
+            log.warning("Deserialize Exception %s", e)
 
     async def create_post(self, text):
         """Creates a new post with the given text, signed with the user's private key"""
@@ -148,12 +263,17 @@ class User:
         message = f"{post[self.last_post_id]['text']}:{post[self.last_post_id]['timestamp']}"
         post[self.last_post_id]["signature"] = base64.b64encode(self.sign(message)).decode('utf-8')
 
-        if self.public_key in self.posts.keys():
-            self.posts[self.public_key].update(post)
-        else:
-            self.posts[self.public_key] = post
+        # The id is made durable before the post is stored or seen by anyone, so a crash can't make us reuse it
+        self.persistence.append({"op": "set", "field": "last_post_id", "value": self.last_post_id})
+        await self.persistence.flush()
+        self.store.put_many(self.public_key, post)
         await self.update_info()
-        await self.sync_subs()
+        if self.dht_replication:
+            chunk = self.chunks.chunk_of(self.last_post_id)
+            first = chunk * self.chunks.chunk_size
+            chunk_posts = self.store.range(self.public_key, first, first + self.chunks.chunk_size - 1)
+            self.schedule(MAINTENANCE, lambda: self.chunks.store(self.public_key, chunk, chunk_posts), ("chunk", chunk))
+        await self.propagate(post)
 
         return post
 
@@ -170,97 +290,113 @@ class User:
 
     def verify_post_signature(self, author_key, post):
         """Verifies the signature of the given post using the author's public key"""
-
-        # Verify the signature using the author's public key
-        message = f"{post['text']}:{post['timestamp']}"
-        author_key = self.deserialize_key(author_key)
-        try:
-            result = author_key.verify(base64.b64decode(post["signature"].encode('utf-8')), message.encode('utf-8'))
-            return result == None
-        except Exception as e:
-            print("Verification Exception " + str(e))
+        return self.verifier.verify_post(author_key, post)
 
     async def write_message(self, ip, port, message):
         """Writes message and waits for an answer"""
         try:
-            reader, writer = await asyncio.open_connection(ip, port)
-            message = json.dumps(message)
-            writer.write(message.encode())
-            writer.write_eof()
-            await writer.drain()
-            line = await reader.read(-1)
-            
-            if line:
-                line = line.strip()
-                line = line.decode()
-                message = json.loads(line)
-                return (True, message)
-            
-            writer.close()
-            await writer.wait_closed()
+            answer = await self.pool.request(ip, port, message)
+            if answer is not None and answer["op"] == "busy":
+                return (False, "busy")
+            if answer is not None and answer["op"] != "error":
+                return (True, answer)
         except Exception as e:
-            print("Write Exception " + str(e) + " in message " + str(message))
+            log.info("Write Exception %s in message %s", e, message["op"])
             return (False, e)
 
     async def send_to_peer(self, public_key, message):
         """Sends a message to peer and processes answer"""
-        print("Getting: " + public_key)
-        peer_info = await self.server.get(public_key)
-        if peer_info is None:
-            return (-2, "Unknown Public Key")
-        peer_info = json.loads(peer_info)
-        ans = await self.write_message(peer_info["ip"], peer_info["port"], message)
-        if ans != None and ans[0]:
-            return (0, "Message sent", ans[1])
-        else:
-            return (-1, "Message not sent", peer_info)
+        # Nodes hosting several users route the message by it
+        message["to"] = public_key
+        await self.node.bootstrapped.wait()
+        with self.metrics.timer("send_to_peer", op=message["op"]):
+            peer_info = await self.peers.get(public_key)
+            if peer_info is None:
+                return (-2, "Unknown Public Key")
+            ans = await self.write_message(peer_info["ip"], peer_info["port"], message)
+            # The peer is shedding load, its address is fine
+            if ans == (False, "busy"):
+                return (-1, "Peer busy", peer_info)
+            if ans == None or not ans[0]:
+                # The cached address may be stale, retry if the DHT has a different one
+                self.peers.invalidate(public_key)
+                fresh_info = await self.peers.get(public_key)
+                if fresh_info is None:
+                    return (-1, "Message not sent", peer_info)
+                if (fresh_info["ip"], fresh_info["port"]) != (peer_info["ip"], peer_info["port"]):
+                    ans = await self.write_message(fresh_info["ip"], fresh_info["port"], message)
+                peer_info = fresh_info
+            if ans != None and ans[0]:
+                return (0, "Message sent", ans[1])
+            else:
+                return (-1, "Message not sent", peer_info)
 
     async def add_subscriber(self, public_key):
         """Adds subscriber to state"""
-        await self.update_subscribers()
         if public_key not in self.subscribers:
-            self.subscribers.append(public_key)
-            await self.update_info()
+            self.subscribers.add(self.keys.intern(public_key))
+            self.persistence.append({"op": "add", "field": "subscribers", "key": public_key})
+        await self.shards.add(self.public_key, self.shards.shards, public_key)
 
     async def remove_subscriber(self, public_key):
         """Removes subscriber from state"""
-        await self.update_subscribers()
         if public_key in self.subscribers:
-            self.subscribers.remove(public_key)
-            await self.update_info()
+            self.subscribers.discard(public_key)
+            self.persistence.append({"op": "remove", "field": "subscribers", "key": public_key})
+        await self.shards.remove(self.public_key, self.shards.shards, public_key)
 
     async def add_subscription(self, public_key):
         """Adds subscription from state"""
         if public_key not in self.subscriptions:
-            self.subscriptions.append(public_key)
+            self.subscriptions.add(self.keys.intern(public_key))
+            self.persistence.append({"op": "add", "field": "subscriptions", "key": public_key})
             await self.update_info()
 
     async def remove_subscription(self, public_key):
         """Removes subscription from state"""
         if public_key in self.subscriptions:
-            self.subscriptions.remove(public_key)
+            self.subscriptions.discard(public_key)
+            self.persistence.append({"op": "remove", "field": "subscriptions", "key": public_key})
             await self.update_info()
 
     async def add_subscription_to_foreign_dht(self, public_key):
         """Adds subscription to other user's entry in the dht"""
-        peer_info = await self.server.get(public_key)
+        peer_info = await self.peers.get(public_key)
+        if peer_info is None:
+            return (-2, "Unknown Public Key")
+        if "subscriber_shards" in peer_info:
+            await self.shards.add(public_key, peer_info["subscriber_shards"], self.public_key)
+            return (0, "Added subscription to DHT with success")
+
+        # Records of older peers hold the whole subscriber list
+        peer_info = await self.dht.get(public_key)
         if peer_info is None:
             return (-2, "Unknown Public Key")
         peer_info = json.loads(peer_info)
         if self.public_key not in peer_info["subscribers"]:
             peer_info["subscribers"].append(self.public_key)
-            await self.server.set(public_key, json.dumps(peer_info))
+            await self.dht.set(public_key, json.dumps(peer_info))
+            self.peers.put(public_key, peer_info)
         return (0, "Added subscription to DHT with success")
 
     async def remove_subscription_from_foreign_dht(self, public_key):
         """Removes subscription to other user's entry in the dht"""
-        peer_info = await self.server.get(public_key)
+        peer_info = await self.peers.get(public_key)
+        if peer_info is None:
+            return (-2, "Unknown Public Key")
+        if "subscriber_shards" in peer_info:
+            await self.shards.remove(public_key, peer_info["subscriber_shards"], self.public_key)
+            return (0, "Removed subscription from DHT with success")
+
+        # Records of older peers hold the whole subscriber list
+        peer_info = await self.dht.get(public_key)
         if peer_info is None:
             return (-2, "Unknown Public Key")
         peer_info = json.loads(peer_info)
         if self.public_key in peer_info["subscribers"]:
             peer_info["subscribers"].remove(self.public_key)
-            await self.server.set(public_key, json.dumps(peer_info))
+            await self.dht.set(public_key, json.dumps(peer_info))
+            self.peers.put(public_key, peer_info)
         return (0, "Removed subscription from DHT with success")
 
     async def subscribe(self, public_key):
@@ -270,6 +406,8 @@ class User:
         message = {
             "op": "subscribe",
             "sender": self.public_key,
+            # Long histories can be imported as a snapshot instead
+            "snapshot": True,
             "timestamp": time.time(),
             # "signature": None,
         }
@@ -285,16 +423,21 @@ class User:
             # Target is offline
             if direct_ans[0] == -1:
                 await self.add_subscription_to_foreign_dht(public_key)
-                peer_subscribers = direct_ans[2]["subscribers"]
-                for sub in peer_subscribers:
-                    if sub != self.public_key:
-                        sub_ans = await self.request_posts(sub, public_key, 0)
-                        if sub_ans[0]:
-                            return (1, "Subscribed and got posts from other subscribers")
+                if self.dht_replication and await self.find_posts_in_dht(public_key):
+                    return (2, "Subscribed and got posts from the DHT")
+                peer_subscribers = [sub for sub in await self.subscribers_of(public_key) or [] if sub != self.public_key]
+                # Someone is waiting on it, so it goes ahead of the background work
+                sub, _ = await self.schedule(INTERACTIVE, lambda: self.fanout.race(
+                    self.fanout.rank(peer_subscribers), lambda sub: self.fetch_history(sub, public_key),
+                    lambda ans: ans[0] == 0, self.hedge_width), ("history", public_key))
+                if sub is not None:
+                    return (1, "Subscribed and got posts from other subscribers")
                 return (-1, "Subscribed but didn't get posts from other subscribers")
 
             # Target is online
-            if direct_ans[2]["posts"] != {}:
+            if direct_ans[2].get("snapshot"):
+                await self.schedule(INTERACTIVE, lambda: self.fetch_history(public_key, public_key), ("history", public_key))
+            elif direct_ans[2]["posts"] != {}:
                 await self.receive_posts(direct_ans[2]["author"], json.loads(direct_ans[2]["posts"]))
             return (0, "Successfully subscribed and got posts directly from target")
 
@@ -312,30 +455,171 @@ class User:
             return (-2, "Didn't unsubscribe. Public Key unknown")
         else:
             await self.remove_subscription(public_key)
-            self.posts.pop(public_key, None)
-            await self.update_info()
+            # Other users on the node may still follow the author
+            self.node.release(public_key)
             if ans[0] == 0:
                 return (0, "Unsubscribed and warned target")
             await self.remove_subscription_from_foreign_dht(public_key)
             return (-1, "Unsubscribed but didn't warn target")
 
-    async def find_posts(self, target_public_key, first_post=0):
-        """Attempts to get posts from an user asking him directly or its subscribers"""
-        direct_ans = await self.request_posts(target_public_key, target_public_key, first_post)
+    async def find_posts(self, target_public_key):
+        """Attempts to get the posts we miss from an user asking him directly or its subscribers"""
+        direct_ans = await self.request_missing(target_public_key, [target_public_key])
         if direct_ans[0] == -1:
-            target_info = await self.server.get(target_public_key)
-            if target_info == None:
-                return (-2, "Didn't request posts. Target Public Key unknown")
-            target_info = json.loads(target_info)
-            for sub in target_info["subscribers"]:
-                if sub != self.public_key:
-                    sub_ans = await self.request_posts(sub, target_public_key, first_post)
-                    if sub_ans[0] == 0:
-                        return (1, "Requested posts to other subscribers")
-            return (-1, "Didn't request posts. Neither target nor subscribers were available")
+            if self.dht_replication and await self.find_posts_in_dht(target_public_key):
+                return (2, "Got posts from the DHT")
+            if await self.request_missing_from_subscribers([target_public_key]):
+                return (-1, "Didn't request posts. Neither target nor subscribers were available")
+            return (1, "Requested posts to other subscribers")
         else:
             return direct_ans
 
+    async def request_missing_from_subscribers(self, authors):
+        """Asks the authors' subscribers for the posts we miss, covering several authors per request
+
+        Returns the authors no subscriber answered for.
+        """
+        authors_subscribers = await self.fanout.run(authors, self.subscribers_of)
+        holders = {}
+        for author, subscribers in authors_subscribers.items():
+            if isinstance(subscribers, list):
+                for sub in subscribers:
+                    if sub != self.public_key:
+                        holders.setdefault(sub, set()).add(author)
+
+        remaining = set(authors)
+        while remaining:
+            wanted = {sub: list(authors & remaining) for sub, authors in holders.items() if authors & remaining}
+            # Subscribers shared by more of the authors are asked first, then the quickest to answer
+            candidates = sorted(wanted, key=lambda sub: (-len(wanted[sub]), self.fanout.latency(sub)))
+            sub, _ = await self.fanout.race(candidates, lambda sub: self.request_missing(sub, wanted[sub]),
+                                            lambda ans: ans[0] == 0, self.hedge_width)
+            if sub is None:
+                break
+            remaining -= set(wanted[sub])
+            del holders[sub]
+        return remaining
+
+    async def request_missing(self, public_key, authors, timeout=None):
+        """Requests the posts we miss from the given authors to a given user (an author or other)
+
+        Replies are bounded by the peer, we keep asking while it says there are more, each round-trip
+        within `timeout` seconds if given. Peers only look at so many authors per request, so they're
+        asked for in batches.
+        """
+        if len(authors) > self.max_authors_per_request:
+            authors = list(authors)
+            for start in range(0, len(authors), self.max_authors_per_request):
+                ans = await self.request_missing(public_key, authors[start:start + self.max_authors_per_request], timeout)
+                if ans[0] != 0:
+                    return ans
+            return (0, "Got posts")
+        while True:
+            have = {author: self.store.ranges(author) for author in authors}
+            message = {
+                "op": "request missing",
+                "sender": self.public_key,
+                "have": have,
+                "timestamp": time.time(),
+                # "signature": None,
+            }
+            try:
+                ans = await asyncio.wait_for(self.send_to_peer(public_key, message), timeout)
+            except asyncio.TimeoutError:
+                return (-1, "Didn't request posts. User timed out")
+            if ans[0] != 0:
+                break
+            stored = 0
+            for author, posts in ans[2]["posts"].items():
+                if author in have:
+                    stored += len(await self.receive_posts(author, posts))
+            # Stop if nothing new was stored, so a peer can't keep us asking forever
+            if not ans[2].get("more") or stored == 0:
+                return (0, "Got posts")
+        if ans[0] == -2:
+            return (-2, "Didn't request posts. Interlocutor Public Key unknown")
+        elif self.pool.is_legacy((ans[2]["ip"], ans[2]["port"])):
+            # Older peers can only send every post from a given id onwards
+            results = []
+            for author, ranges in have.items():
+                first_post = ranges[0][1] + 1 if ranges and ranges[0][0] == 0 else 0
+                results.append(await self.request_posts(public_key, author, first_post))
+            return min(results)
+        else:
+            return (-1, "Didn't request posts. User offline")
+
+    async def fetch_history(self, public_key, author):
+        """Gets the posts we miss from an author from a peer, as a snapshot if the peer can export one"""
+        ans = await self.import_snapshot(public_key, author)
+        if ans[0] == 0:
+            return ans
+        return await self.request_missing(public_key, [author])
+
+    async def import_snapshot(self, public_key, author):
+        """Imports the history of an author from a peer's snapshot, one segment at a time
+
+        Segments are checked against the hashes in the index and their posts against the author's
+        signatures, then stored right away, so an interrupted import resumes from what was kept.
+        """
+        held = self.store.ranges(author)
+        message = {
+            "op": "snapshot index",
+            "sender": self.public_key,
+            "author": author,
+            "from_id": Snapshot.resume_point(held),
+            "timestamp": time.time(),
+        }
+        ans = await self.send_to_peer(public_key, message)
+        if ans[0] == -2:
+            return (-2, "Didn't import snapshot. Interlocutor Public Key unknown")
+        elif ans[0] != 0:
+            return (-1, "Didn't import snapshot. Peer unavailable or unable to export one")
+        index = ans[2]["index"]
+        if index["format"] != Snapshot.FORMAT:
+            return (-1, "Didn't import snapshot. Unknown format")
+
+        for segment in index["segments"]:
+            if any(start <= segment["first"] and segment["last"] <= end for start, end in held):
+                self.metrics.inc("snapshot_segments_total", result="held")
+                continue
+            message = {
+                "op": "snapshot segment",
+                "sender": self.public_key,
+                "author": author,
+                "first": segment["first"],
+                "last": segment["last"],
+                "timestamp": time.time(),
+            }
+            ans = await self.send_to_peer(public_key, message)
+            if ans[0] != 0:
+                return (-1, "Snapshot import interrupted. Peer unavailable")
+            posts = ans[2]["posts"]
+            if len(posts) != segment["count"] or Snapshot.segment_hash(posts) != segment["hash"]:
+                self.metrics.inc("snapshot_segments_total", result="corrupt")
+                return (-1, "Snapshot import interrupted. Segment doesn't match the index")
+            await self.receive_posts(author, posts)
+            self.metrics.inc("snapshot_segments_total", result="imported")
+        return (0, "Imported snapshot")
+
+    def misses_posts(self, author_key, last_post_id):
+        """Checks whether any post of an author up to the given id is missing, the id being a peer's claim"""
+        return self.store.misses(author_key, last_post_id)
+
+    def missing_ids(self, author_key, last_post_id, limit=None):
+        """Ids of the posts of an author up to the given id that we don't have, evicted ones aside"""
+        return self.store.missing_ids(author_key, last_post_id, limit)
+
+    async def find_posts_in_dht(self, author_key):
+        """Fetches the posts we miss from the author's chunks in the dht, True if none is left missing"""
+        peer_info = await self.peers.get(author_key)
+        if peer_info is None:
+            return False
+        # The last id comes from the DHT record, a bounded number of chunks is fetched at a time
+        missing = self.missing_ids(author_key, int(peer_info["last_post_id"]), self.fanout.limit * self.chunks.chunk_size)
+        if missing:
+            await self.receive_posts(author_key, await self.chunks.fetch(author_key, missing))
+        return not self.misses_posts(author_key, int(peer_info["last_post_id"]))
+
     async def request_posts(self, public_key, target_public_key, first_post=0):
         """Attempts to request posts from a target user to a given user (the author or other)"""
         message = {
@@ -347,7 +631,7 @@ class User:
             # "signature": None,
         }
         # message["signature"] = self.sign(f"{message['op']}:{message['sender']}:{message['target']}:{message['first_post']}:{message['timestamp']}")
-        if await self.server.get(target_public_key) == None:
+        if await self.peers.get(target_public_key) == None:
             return (-3, "Didn't request posts. Target Public Key unknown")
         ans = await self.send_to_peer(public_key, message)
         if ans[0] == -2:
@@ -360,16 +644,18 @@ class User:
             return (-1, "Didn't request posts. User offline")
 
     async def receive_posts(self, author_key, posts):
-        """Validates received posts (using the signature) and chooses which ones to keep"""
-        for item in posts.items():
-            if self.verify_post_signature(author_key, item[1]):
-                if author_key in self.posts.keys():
-                    if item[0] not in self.posts[author_key].keys():
-                        self.posts[author_key].update({int(item[0]): item[1]})
-                else:
-                    self.posts[author_key]= {int(item[0]): item[1]}
-        await self.update_info()
-                
+        """Validates received posts (using the signature) and keeps them, returning the ids of the new ones"""
+        # Posts we already hold don't need to be verified again
+        posts = {int(id): post for id, post in posts.items()}
+        new_posts = {id: posts[id] for id in self.store.unknown_ids(author_key, posts)}
+        valid_ids = await self.verifier.verify_posts(author_key, new_posts)
+        return self.store_posts(author_key, {id: new_posts[id] for id in valid_ids})
+
+    def store_posts(self, author_key, posts):
+        """Keeps the given already verified posts, returning the ids that weren't stored yet"""
+        # Another batch may have stored the same posts while this one was being verified
+        return self.store.put_many(author_key, posts)
+
     async def send_sync(self, public_key):
         """Attempts to send sync message to a given user"""
         message = {
@@ -388,18 +674,128 @@ class User:
         else:
             return (-1, "Didn't send sync. User offline")
     
+    async def propagate(self, posts):
+        """Sends our new posts to the subscribers according to the propagation mode"""
+        if self.propagation == "sync":
+            return await self.sync_subs()
+        await self.update_subscribers(self.subscribers_max_age)
+        return await self.push_posts(self.public_key, posts, self.last_post_id, sorted(self.subscribers))
+
+    async def push_posts(self, author_key, posts, last_post_id, targets):
+        """Pushes an author's posts to the targets
+
+        In gossip mode the targets are split in up to `gossip_fanout` groups and only the first
+        reachable member of each group is contacted, being left in charge of relaying to the rest.
+        """
+        if self.propagation == "gossip":
+            groups = [tuple(targets[i::self.gossip_fanout]) for i in range(min(self.gossip_fanout, len(targets)))]
+        else:
+            groups = [(target,) for target in targets]
+
+        async def deliver(group):
+            for index, head in enumerate(group):
+                ans = await self.send_push(head, author_key, posts, last_post_id, list(group[index + 1:]))
+                if ans[0] == 0:
+                    return ans
+                # A synced legacy peer can't relay, the next member heads the rest of the group
+                if ans[0] == 1 and index == len(group) - 1:
+                    return (0, "Pushed posts")
+            return (-1, "Didn't push posts. No one in the group was available")
+
+        longest = max((len(group) for group in groups), default=1)
+        return await self.fanout.run(groups, deliver, self.fanout.timeout * longest)
+
+    async def send_push(self, public_key, author_key, posts, last_post_id, forward):
+        """Attempts to send posts to a given user, who relays them to the forward list"""
+        message = {
+            "op": "push",
+            "sender": self.public_key,
+            "author": author_key,
+            "posts": posts,
+            "last_post_id": last_post_id,
+            "forward": forward,
+            "timestamp": time.time(),
+            # "signature": None,
+        }
+        ans = await self.send_to_peer(public_key, message)
+        if ans[0] == -2:
+            return (-2, "Didn't push posts. Public Key unknown")
+        elif ans[0] == 0 and ans[2]["op"] == "acknowledge":
+            return (0, "Pushed posts")
+        elif ans[0] == 0:
+            return (-1, "Didn't push posts. Declined")
+        elif author_key == self.public_key and self.pool.is_legacy((ans[2]["ip"], ans[2]["port"])):
+            # Older peers don't understand pushes but still fetch our posts when synced, they can't relay them though
+            ans = await self.send_sync(public_key)
+            return (1, "Synced legacy peer") if ans[0] == 0 else ans
+        else:
+            return (-1, "Didn't push posts. User offline")
+
+    async def accept_push(self, author_key, forward, sender):
+        """Checks whether we take a push and relay it to the forward list, returning the list we'd relay to or None
+
+        Only pushes of authors we follow are taken, and only relayed within their tree, so replaying signed
+        posts with a long forward list doesn't turn us into an amplifier.
+        """
+        if author_key not in self.subscriptions:
+            return None
+        forward = [target for target in forward[:self.max_forward] if target not in (self.public_key, sender)]
+        if forward and not await self.in_tree_of(author_key, sender):
+            return None
+        return forward
+
+    async def receive_push(self, author_key, posts, last_post_id, forward):
+        """Keeps accepted pushed posts, relays them down the gossip tree and fetches any post still missing
+
+        The posts are relayed even if we had them, the rest of the tree may not.
+        """
+        posts = {int(id): post for id, post in posts.items()}
+        valid_ids = await self.verifier.verify_posts(author_key, posts)
+        # Tampered pushes aren't relayed
+        if len(valid_ids) != len(posts):
+            return
+        self.store_posts(author_key, posts)
+        if forward:
+            self.schedule(PROPAGATION, lambda: self.push_posts(author_key, posts, last_post_id, forward))
+        if self.misses_posts(author_key, last_post_id):
+            self.schedule(REPAIR, lambda: self.find_posts(author_key), ("find_posts", author_key))
+
+    async def in_tree_of(self, author_key, sender):
+        """Checks whether a peer is the author or, by its DHT record, one of its subscribers"""
+        if sender == author_key:
+            return True
+        peer_info = await self.peers.get(sender) if sender is not None else None
+        return peer_info is not None and author_key in peer_info.get("subscriptions", [])
+
     async def sync_subs(self):
         """Attempts to send sync messages to all its subscribers"""
-        await self.update_subscribers()
-        for sub in self.subscribers:
-            await self.send_sync(sub)
-        
+        await self.update_subscribers(self.subscribers_max_age)
+        return await self.fanout.run(sorted(self.subscribers), self.send_sync)
+
     async def update_timeline(self):
-        """Updates timeline by requesting posts to all its subscriptions"""
-        for public_key in self.subscriptions:
-            if public_key in self.posts and len(self.posts[public_key]) > 0:
-                post_latest_id = int(max(self.posts[public_key].keys()))
-                await self.find_posts(public_key, post_latest_id + 1)
-            else:
-                await self.find_posts(public_key, 0)
-        return self.posts
+        """Updates timeline by requesting the posts we miss to all its subscriptions
+
+        The authors that posted most recently are asked first, as their posts top the timeline.
+        """
+        newest = self.store.newest(self.subscriptions)
+        authors = sorted(self.subscriptions, key=lambda author: newest.get(author, 0), reverse=True)
+        self.progress["authors"] = len(authors)
+        self.progress["authors_done"] = 0
+
+        async def catch_up(public_key):
+            try:
+                # A long history takes many round-trips, only each of them is timed out
+                return await self.request_missing(public_key, [public_key], self.fanout.timeout)
+            finally:
+                self.progress["authors_done"] += 1
+
+        # Queued behind the user's own and more urgent work, most recent authors first
+        jobs = [self.schedule(MAINTENANCE, lambda public_key=public_key: catch_up(public_key), ("catch up", public_key))
+                for public_key in authors]
+        results = dict(zip(authors, await asyncio.gather(*jobs, return_exceptions=True)))
+        offline = [public_key for public_key, ans in results.items() if isinstance(ans, Exception) or ans[0] == -1]
+        if offline and self.dht_replication:
+            results = await self.fanout.run(offline, self.find_posts_in_dht)
+            offline = [public_key for public_key, found in results.items() if found is not True]
+        if offline:
+            await self.request_missing_from_subscribers(offline)
@@ -0,0 +1,84 @@
+import asyncio
+import base64
+import functools
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from cryptography.hazmat.primitives import serialization
+
+log = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=4096)
+def load_public_key(public_key):
+    """Parses a PEM public key, caching the parsed key object"""
+    return serialization.load_pem_public_key(public_key.encode('utf-8'))
+
+
+def post_message(post):
+    """Returns the signed content of a post"""
+    return f"{post['text']}:{post['timestamp']}".encode('utf-8')
+
+
+def verify_batch(public_key, items):
+    """Verifies (id, message, signature) items with the given PEM key and returns the ids of valid ones"""
+    key = load_public_key(public_key)
+    valid = []
+    for id, message, signature in items:
+        try:
+            key.verify(signature, message)
+            valid.append(id)
+        except Exception:
+            pass
+    return valid
+
+
+class Verifier:
+    """Verifies post signatures, offloading large batches to a thread or process pool"""
+
+    def __init__(self, metrics, executor="thread", batch_threshold=64, chunk_size=256):
+        self.metrics = metrics
+        self.batch_threshold = batch_threshold
+        self.chunk_size = chunk_size
+        if executor == "process":
+            self.executor = ProcessPoolExecutor()
+        elif executor == "thread":
+            self.executor = ThreadPoolExecutor()
+        else:
+            self.executor = None
+
+    def verify_post(self, author_key, post):
+        """Verifies the signature of a single post"""
+        self.metrics.inc("posts_verified_total")
+        try:
+            with self.metrics.timer("verify", batch="single"):
+                load_public_key(author_key).verify(base64.b64decode(post["signature"].encode('utf-8')), post_message(post))
+            return True
+        except Exception as e:
+            log.warning("Verification Exception %s", e)
+            return False
+
+    async def verify_posts(self, author_key, posts):
+        """Verifies a {id: post} dict and returns the ids of the posts with a valid signature"""
+        items = []
+        for id, post in posts.items():
+            try:
+                items.append((id, post_message(post), base64.b64decode(post["signature"].encode('utf-8'))))
+            except Exception as e:
+                log.warning("Verification Exception %s", e)
+
+        self.metrics.inc("posts_verified_total", len(items))
+        if self.executor is None or len(items) < self.batch_threshold:
+            with self.metrics.timer("verify", batch="inline"):
+                return verify_batch(author_key, items)
+
+        loop = asyncio.get_running_loop()
+        chunks = [items[i:i + self.chunk_size] for i in range(0, len(items), self.chunk_size)]
+        with self.metrics.timer("verify", batch="pool"):
+            results = await asyncio.gather(*(loop.run_in_executor(self.executor, verify_batch, author_key, chunk)
+                                             for chunk in chunks))
+        return [id for chunk_ids in results for id in chunk_ids]
+
+    def close(self):
+        """Shuts the pool down"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
@@ -0,0 +1,174 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import tempfile
+import time
+import tracemalloc
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from User import User
+
+
+class BenchUser(User):
+    """User that records when each post reaches it"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.arrivals = {}
+
+    def store_posts(self, author_key, posts):
+        now = time.time()
+        for id in posts:
+            self.arrivals.setdefault((author_key, int(id)), now)
+        return super().store_posts(author_key, posts)
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def start_nodes(args, directory):
+    """Starts the bootstrap node followed by the others, a few at a time"""
+    def make_node(index):
+        kademlia_port = args.base_port + 2 * index
+        bootstrap_nodes = [] if index == 0 else [("127.0.0.1", args.base_port)]
+        return BenchUser(Ed25519PrivateKey.generate(), "127.0.0.1", kademlia_port, kademlia_port + 1, bootstrap_nodes,
+                         os.path.join(directory, f"node{index}.json"), propagation=args.propagation)
+
+    async def start(node):
+        await node.start()
+        # Starting only begins joining, the node's record must be in the DHT before anyone follows it
+        await node.node.bootstrapped.wait()
+        await asyncio.wait([node.joining])
+
+    bootstrap = make_node(0)
+    await start(bootstrap)
+    nodes = [bootstrap] + [make_node(index) for index in range(1, args.nodes)]
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def start_limited(node):
+        async with semaphore:
+            await start(node)
+
+    await asyncio.gather(*(start_limited(node) for node in nodes[1:]))
+    return nodes
+
+
+async def build_follow_graph(args, nodes):
+    """Makes each node subscribe to random others and returns the followers of each node"""
+    followers = {node.public_key: [] for node in nodes}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def follow(node, target):
+        async with semaphore:
+            ans = await node.subscribe(target.public_key)
+        if ans[0] >= 0:
+            followers[target.public_key].append(node)
+
+    follows = []
+    for node in nodes:
+        others = [other for other in nodes if other is not node]
+        for target in random.sample(others, min(args.follows, len(others))):
+            follows.append(follow(node, target))
+    await asyncio.gather(*follows)
+    return followers
+
+
+async def run(args):
+    """Runs the benchmark and returns its results"""
+    tracemalloc.start()
+    directory = tempfile.mkdtemp(prefix="sdle-bench-")
+    setup_start = time.perf_counter()
+    nodes = await start_nodes(args, directory)
+    followers = await build_follow_graph(args, nodes)
+    setup_time = time.perf_counter() - setup_start
+    memory_per_node = tracemalloc.get_traced_memory()[0] / len(nodes)
+
+    def totals():
+        messages = sum(node.metrics.total("messages_sent_total") for node in nodes)
+        sent_bytes = sum(node.metrics.total("bytes_sent_total") for node in nodes)
+        writes = [node.metrics.histogram_total("persistence_write_seconds") for node in nodes]
+        return messages, sent_bytes, sum(count for count, _ in writes), sum(seconds for _, seconds in writes)
+
+    setup_totals = totals()
+
+    # Post at the given rate from random authors
+    created = []
+    posting = []
+    interval = 1 / args.rate
+    deadline = time.perf_counter() + args.duration
+    while time.perf_counter() < deadline:
+        author = random.choice(nodes)
+
+        async def publish(author=author):
+            post = await author.create_post("benchmark post")
+            id, content = next(iter(post.items()))
+            created.append((author.public_key, id, content["timestamp"]))
+
+        posting.append(asyncio.ensure_future(publish()))
+        await asyncio.sleep(interval)
+    await asyncio.gather(*posting)
+    await asyncio.sleep(args.settle)
+
+    latencies = []
+    expected = 0
+    for author_key, id, timestamp in created:
+        for follower in followers[author_key]:
+            expected += 1
+            arrival = follower.arrivals.get((author_key, id))
+            if arrival is not None:
+                latencies.append(arrival - timestamp)
+    latencies.sort()
+
+    # Only what happened after the setup counts
+    messages, sent_bytes, writes, write_time = (after - before for after, before in zip(totals(), setup_totals))
+    posts = max(len(created), 1)
+
+    await asyncio.gather(*(node.stop() for node in nodes))
+
+    return {
+        "config": vars(args),
+        "setup_seconds": setup_time,
+        "posts": len(created),
+        "deliveries_expected": expected,
+        "deliveries": len(latencies),
+        "latency_seconds": {
+            "p50": percentile(latencies, 0.5),
+            "p90": percentile(latencies, 0.9),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1] if latencies else None,
+        },
+        "messages_per_post": messages / posts,
+        "bytes_per_post": sent_bytes / posts,
+        "persistence_writes": writes,
+        "persistence_write_ms_mean": 1000 * write_time / writes if writes else None,
+        "memory_bytes_per_node": memory_per_node,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test with many in-process nodes on loopback")
+    parser.add_argument("--nodes", type=int, default=10, help="number of nodes, including the bootstrap node")
+    parser.add_argument("--follows", type=int, default=3, help="subscriptions per node")
+    parser.add_argument("--rate", type=float, default=5, help="posts per second across all nodes")
+    parser.add_argument("--duration", type=float, default=10, help="seconds spent posting")
+    parser.add_argument("--settle", type=float, default=5, help="seconds to wait for propagation after posting")
+    parser.add_argument("--propagation", default="gossip", choices=["sync", "push", "gossip"])
+    parser.add_argument("--concurrency", type=int, default=20, help="nodes started or subscribing at once")
+    parser.add_argument("--base-port", type=int, default=20000)
+    parser.add_argument("--output", help="file to write the JSON results to, stdout if not given")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    output = json.dumps(results, indent=4)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as output_file:
+            output_file.write(output)
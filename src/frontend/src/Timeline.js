@@ -31,6 +31,9 @@ import Html5QrcodePlugin from "./Html5QrcodePlugin";
 
 export default function TwitterFeed() {
   const [posts, setPosts] = React.useState([]);
+  const [olderPosts, setOlderPosts] = React.useState([]);
+  const [firstPageCursor, setFirstPageCursor] = React.useState(null);
+  const [olderCursor, setOlderCursor] = React.useState(null);
   const [searchQuery, setSearchQuery] = React.useState("");
   const [alias, setAlias] = React.useState("");
   const [QRalias, setQRAlias] = React.useState("");
@@ -50,6 +53,13 @@ export default function TwitterFeed() {
 
   const API_ENDPOINT = params.get("api")
 
+  // The API serves the timeline a page at a time, the cursor of the next one comes in the headers
+  const nextCursor = (response) => {
+    const beforeTs = response.headers.get("X-Next-Before-Ts");
+    if (beforeTs === null)
+      return null;
+    return { before_ts: beforeTs, after_id: response.headers.get("X-Next-After-Id") };
+  };
   const fetchData = async () => {
     const response = await fetch(API_ENDPOINT + "timeline", {
       method: "GET",
@@ -58,7 +68,24 @@ export default function TwitterFeed() {
     });
     const json = await response.json();
     setPosts(json);
+    setFirstPageCursor(nextCursor(response));
+  };
+  const cursor = olderPosts.length ? olderCursor : firstPageCursor;
+  const fetchOlder = async () => {
+    if (cursor === null)
+      return;
+    const response = await fetch(API_ENDPOINT + "timeline?" + new URLSearchParams(cursor), {
+      method: "GET",
+      mode: "cors",
+      cache: "no-store",
+    });
+    const json = await response.json();
+    setOlderPosts(olderPosts.concat(json));
+    setOlderCursor(nextCursor(response));
   };
+  // The first page is refreshed while older ones stay, posts moving between them are shown once
+  const shown = new Set(posts.map((post) => post.author + ":" + post.id));
+  const timeline = posts.concat(olderPosts.filter((post) => !shown.has(post.author + ":" + post.id)));
   const fetchPubKey = async () => {
     const response = await fetch(API_ENDPOINT + "pubkey", {
       method: "GET",
@@ -593,7 +620,7 @@ export default function TwitterFeed() {
         </Box>
         <CardContent style={{ marginLeft: "25px", marginRight: "25px" }}>
           <Grid container direction="column" spacing={2}>
-            {posts.map((post, index) => (
+            {timeline.map((post, index) => (
               <Grid item key={index}>
                 <Grid container alignItems="center" spacing={1}>
                   <Grid item>
@@ -614,6 +641,13 @@ export default function TwitterFeed() {
               </Grid>
             ))}
           </Grid>
+          {cursor !== null && (
+            <Box sx={{ display: "flex", justifyContent: "center", marginTop: "25px" }}>
+              <Button variant="outlined" color="primary" onClick={fetchOlder}>
+                Load older posts
+              </Button>
+            </Box>
+          )}
         </CardContent>
       </Card>
     </div>
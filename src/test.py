@@ -66,58 +66,66 @@ if __name__ == "__main__":
     loop.create_task(user.print_timeline())
     '''
 
-    alice = User(Ed25519PrivateKey.generate(), "127.0.0.1", 1233, 5007, persistence_file="alice_vieira4.json")
+    async def main():
+        alice = User(Ed25519PrivateKey.generate(), "127.0.0.1", 1233, 5007, persistence_file="alice_vieira4.json")
+        await alice.start()
 
-    bob = User(Ed25519PrivateKey.generate(), "127.0.0.2", 1234, 5002, [("127.0.0.1", 1233)], persistence_file="bob_vance4.json")
+        bob = User(Ed25519PrivateKey.generate(), "127.0.0.2", 1234, 5002, [("127.0.0.1", 1233)], persistence_file="bob_vance4.json")
+        await bob.start()
 
-    print("ALICE KEY:" + str(alice.public_key))
-    print("BOB KEY:" + str(bob.public_key))
+        print("ALICE KEY:" + str(alice.public_key))
+        print("BOB KEY:" + str(bob.public_key))
 
-    print("ALICE POSTS:" + str(alice.posts))
+        print("ALICE POSTS:" + str(alice.get_posts()))
 
-    alice.loop.run_until_complete(alice.create_post("Hola soy Aliceee"))
+        await alice.create_post("Hola soy Aliceee")
     
-    alice.loop.run_until_complete(alice.create_post("Ou em tuga: Olá sou a Aliceee"))
+        await alice.create_post("Ou em tuga: Olá sou a Aliceee")
         
-    print("ALICE POSTS2:" + str(alice.posts))
+        print("ALICE POSTS2:" + str(alice.get_posts()))
 
-    print("BOB POSTS:" + str(bob.posts))
+        print("BOB POSTS:" + str(bob.get_posts()))
     
-    print("ALICE SUBSCRIB:" + str(alice.subscribers))
+        print("ALICE SUBSCRIB:" + str(alice.subscribers))
 
-    print("BOB SUBSCRIP:" + str(bob.subscriptions))
+        print("BOB SUBSCRIP:" + str(bob.subscriptions))
 
-    bob.loop.run_until_complete(bob.subscribe(alice.public_key))
-    bob.loop.run_until_complete(bob.subscribe(alice.public_key))
+        await bob.subscribe(alice.public_key)
+        await bob.subscribe(alice.public_key)
             
-    print("ALICE SUBSCRIB2:" + str(alice.subscribers))
+        print("ALICE SUBSCRIB2:" + str(alice.subscribers))
     
-    print("BOB SUBSCRIP2:" + str(bob.subscriptions))
+        print("BOB SUBSCRIP2:" + str(bob.subscriptions))
     
-    print("BOB POSTS2:" + str(bob.posts))
+        print("BOB POSTS2:" + str(bob.get_posts()))
     
-    alice.loop.run_until_complete(alice.create_post("No teu país das maravilhas"))
+        await alice.create_post("No teu país das maravilhas")
         
-    print("ALICE POSTS3:" + str(alice.posts))
+        print("ALICE POSTS3:" + str(alice.get_posts()))
 
-    #bob.loop.run_until_complete(bob.update_timeline())
+        #await bob.update_timeline()
     
-    #bob.loop.run_until_complete(bob.update_timeline())
+        #await bob.update_timeline()
     
-    print("BOB POSTS3:" + str(bob.posts))
+        print("BOB POSTS3:" + str(bob.get_posts()))
     
-    #bob.loop.run_until_complete(bob.unsubscribe(alice.public_key))
+        #await bob.unsubscribe(alice.public_key)
         
-    print("ALICE SUBSCRIB3:" + str(alice.subscribers))
+        print("ALICE SUBSCRIB3:" + str(alice.subscribers))
     
-    print("BOB SUBSCRIP3:" + str(bob.subscriptions))
+        print("BOB SUBSCRIP3:" + str(bob.subscriptions))
     
-    alice.loop.run_until_complete(alice.create_post("Last call"))
+        await alice.create_post("Last call")
     
-    print("ALICE POSTS4:" + str(alice.posts))
+        print("ALICE POSTS4:" + str(alice.get_posts()))
     
-    print("BOB POSTS4:" + str(bob.posts))
+        print("BOB POSTS4:" + str(bob.get_posts()))
         
-    #bob.loop.run_until_complete(bob.update_timeline())
+        #await bob.update_timeline()
     
-    #print("BOB POSTS5:" + str(bob.posts))
+        #print("BOB POSTS5:" + str(bob.get_posts()))
+
+        await bob.stop()
+        await alice.stop()
+
+    asyncio.run(main())
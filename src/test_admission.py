@@ -0,0 +1,39 @@
+import unittest
+from Admission import Admission
+from Metrics import Metrics
+
+
+class AdmissionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.admission = Admission(Metrics(), rate=0.001, burst=40, address_rate=0.001, address_burst=100)
+
+    def test_rotating_senders_share_the_address_bucket(self):
+        allowed = sum(self.admission.allow("10.0.0.1", f"sender {i}") for i in range(200))
+        self.assertEqual(allowed, 100)
+        self.assertFalse(self.admission.allow("10.0.0.1"))
+
+    def test_sender_bucket_within_its_address(self):
+        allowed = sum(self.admission.allow("10.0.0.1", "sender") for _ in range(100))
+        self.assertEqual(allowed, 40)
+        self.assertTrue(self.admission.allow("10.0.0.1", "other"))
+
+    def test_made_up_senders_dont_evict_other_addresses(self):
+        for _ in range(40):
+            self.admission.allow("10.0.0.2", "peer")
+        for i in range(10000):
+            self.admission.allow("10.0.0.1", f"sender {i}")
+        self.assertFalse(self.admission.allow("10.0.0.2", "peer"))
+        self.assertLessEqual(len(self.admission.buckets["10.0.0.1"][1]), self.admission.senders_per_address)
+
+    def test_connections_capped_per_address_and_sender(self):
+        self.assertTrue(all(self.admission.connect("10.0.0.1", "sender") for _ in range(8)))
+        self.assertFalse(self.admission.connect("10.0.0.1", "sender"))
+        self.assertEqual(sum(self.admission.connect("10.0.0.1", f"sender {i}") for i in range(100)), 56)
+        self.admission.disconnect("10.0.0.1", "sender")
+        self.assertTrue(self.admission.connect("10.0.0.1", "sender"))
+        self.assertFalse(self.admission.connect("10.0.0.1", "another"))
+
+
+if __name__ == "__main__":
+    unittest.main()
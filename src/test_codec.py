@@ -0,0 +1,52 @@
+import base64
+import os
+import unittest
+import zlib
+import Codec
+
+
+def message():
+    author = Codec.raw_to_pem(os.urandom(32))
+    return {
+        "op": "send posts",
+        "sender": author,
+        "author": author,
+        "posts": {str(id): {"text": "x" * 100, "timestamp": 1.5, "signature": base64.b64encode(os.urandom(64)).decode()}
+                  for id in range(50)},
+    }
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for codec in (Codec.JSON, Codec.MSGPACK):
+            original = message()
+            data = Codec.encode(original, codec)
+            self.assertTrue(data[0] & Codec.COMPRESSED)
+            self.assertEqual(Codec.decode(data, 1 << 20), original)
+
+    def test_msgpack_is_more_compact(self):
+        original = message()
+        uncompressed = 1 << 30
+        self.assertLess(len(Codec.encode(original, Codec.MSGPACK, uncompressed)),
+                        len(Codec.encode(original, Codec.JSON, uncompressed)))
+
+    def test_inflated_size_is_bounded(self):
+        data = Codec.encode({"op": "push", "text": "a" * (1 << 20)})
+        self.assertLess(len(data), 1 << 12)
+        with self.assertRaises(ValueError):
+            Codec.decode(data, 1 << 16)
+        self.assertEqual(len(Codec.decode(data, 2 << 20)["text"]), 1 << 20)
+
+    def test_bomb_isnt_inflated_whole(self):
+        bomb = bytes([Codec.JSON | Codec.COMPRESSED]) + zlib.compress(b" " * (64 << 20), 9)
+        with self.assertRaises(ValueError):
+            Codec.decode(bomb, 1 << 20)
+
+    def test_foreign_pem_keys_are_kept(self):
+        original = {"sender": Codec.PEM_HEADER + "bm90IGEga2V5" + Codec.PEM_FOOTER, "signature": "not base64!"}
+        self.assertEqual(Codec.decode(Codec.encode(original, Codec.MSGPACK)), original)
+
+
+if __name__ == "__main__":
+    unittest.main()
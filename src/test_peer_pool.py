@@ -0,0 +1,59 @@
+import asyncio
+import json
+import unittest
+from Metrics import Metrics
+from PeerPool import PeerPool
+
+
+class PeerPoolTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.pool = PeerPool(Metrics(), handshake_timeout=0.1, legacy_ttl=0.2)
+        self.server = None
+
+    async def asyncTearDown(self):
+        await self.pool.close()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def serve(self, handler):
+        self.server = await asyncio.start_server(handler, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def test_older_peer_is_retried_after_legacy_ttl(self):
+        async def one_shot(reader, writer):
+            # Older receivers read the whole message up to the end of the stream
+            data = await reader.read(-1)
+            if data.startswith(b"{"):
+                writer.write(json.dumps({"op": "acknowledge"}).encode())
+            writer.close()
+
+        ip, port = await self.serve(one_shot)
+        self.assertEqual(await self.pool.request(ip, port, {"op": "sync"}), {"op": "acknowledge"})
+        self.assertTrue(self.pool.is_legacy((ip, port)))
+        await asyncio.sleep(0.25)
+        self.assertFalse(self.pool.is_legacy((ip, port)))
+
+    async def test_closed_handshake_isnt_legacy(self):
+        async def close(reader, writer):
+            writer.close()
+
+        ip, port = await self.serve(close)
+        with self.assertRaises(ConnectionError):
+            await self.pool.request(ip, port, {"op": "sync"})
+        self.assertFalse(self.pool.is_legacy((ip, port)))
+
+    async def test_other_reply_is_legacy(self):
+        async def other(reader, writer):
+            await reader.read(1)
+            writer.write(b"HTTP/1.1 400 Bad Request\r\n\r\n")
+            writer.close()
+
+        ip, port = await self.serve(other)
+        await self.pool.connect((ip, port))
+        self.assertTrue(self.pool.is_legacy((ip, port)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import json
+import os
+import tempfile
+import unittest
+from Metrics import Metrics
+from Persistence import Persistence
+
+
+class PersistenceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "user.json")
+        self.state = {"subscribers": [], "subscriptions": [], "last_post_id": -1}
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def persistence(self, compact_every=1000):
+        return Persistence(self.path, lambda: dict(self.state), Metrics(), compact_every)
+
+    def change(self, persistence, entry):
+        if entry["op"] == "set":
+            self.state[entry["field"]] = entry["value"]
+        elif entry["op"] == "add":
+            self.state[entry["field"]] = self.state[entry["field"]] + [entry["key"]]
+        persistence.append(entry)
+
+    def test_torn_tail_is_dropped(self):
+        persistence = self.persistence()
+        persistence.append({"op": "add", "field": "subscribers", "key": "a"})
+        persistence.append({"op": "set", "field": "last_post_id", "value": 3})
+        size = os.path.getsize(persistence.log_path)
+        with open(persistence.log_path, "a") as log_file:
+            log_file.write('{"op": "set", "field": "last_post_id", "va')
+
+        persistence = self.persistence()
+        state = persistence.load()
+        self.assertEqual(state["subscribers"], ["a"])
+        self.assertEqual(state["last_post_id"], 3)
+        self.assertEqual(os.path.getsize(persistence.log_path), size)
+        # Appends after the truncation start on a line of their own
+        persistence.append({"op": "set", "field": "last_post_id", "value": 4})
+        self.assertEqual(self.persistence().load()["last_post_id"], 4)
+
+    def test_replay_after_compaction(self):
+        persistence = self.persistence(compact_every=3)
+        for id in range(5):
+            self.change(persistence, {"op": "set", "field": "last_post_id", "value": id})
+        self.change(persistence, {"op": "add", "field": "subscriptions", "key": "b"})
+        self.assertEqual(persistence.generation, 2)
+        self.assertEqual(os.listdir(self.directory.name), ["user.json"])
+
+        persistence = self.persistence()
+        state = persistence.load()
+        self.assertEqual(state["last_post_id"], 4)
+        self.assertEqual(state["subscriptions"], ["b"])
+        self.assertEqual(persistence.generation, 2)
+
+    def test_crash_before_old_log_is_removed(self):
+        persistence = self.persistence()
+        self.change(persistence, {"op": "add", "field": "subscribers", "key": "a"})
+        self.state["subscribers"] = []
+        old_log_path = persistence.log_path
+        with open(old_log_path) as log_file:
+            old_log = log_file.read()
+        persistence.compact()
+        # As if the process died right after the new snapshot was in place
+        with open(old_log_path, "w") as log_file:
+            log_file.write(old_log)
+
+        state = self.persistence().load()
+        self.assertEqual(state["subscribers"], [])
+
+    def test_crash_before_snapshot_is_replaced(self):
+        persistence = self.persistence()
+        self.change(persistence, {"op": "set", "field": "last_post_id", "value": 7})
+        with open(self.path + ".tmp", "w") as tmp_file:
+            tmp_file.write(json.dumps(dict(self.state, last_post_id=0, generation=1))[:10])
+
+        persistence = self.persistence()
+        self.assertEqual(persistence.load()["last_post_id"], 7)
+        self.assertEqual(persistence.generation, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
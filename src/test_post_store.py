@@ -0,0 +1,80 @@
+import os
+import time
+import unittest
+from Codec import raw_to_pem
+from KeyRegistry import KeyRegistry
+from PostStore import PostStore
+
+
+def new_key():
+    return raw_to_pem(os.urandom(32))
+
+
+def posts(ids):
+    return {id: {"text": f"post {id}", "timestamp": float(id), "signature": "c2ln"} for id in ids}
+
+
+class PostStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.keys = KeyRegistry()
+        self.store = PostStore(":memory:", self.keys)
+        self.author = new_key()
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_lookups_dont_register_keys(self):
+        self.store.put_many(self.author, posts(range(3)))
+        for _ in range(100):
+            author = new_key()
+            self.assertEqual(self.store.missing(author, [[0, 5]]), {})
+            self.assertEqual(self.store.range(author), {})
+            self.assertEqual(self.store.count(author), 0)
+        self.assertEqual(list(self.keys.pems), [self.author])
+        self.assertEqual(self.store.timeline()[0][0], self.author)
+
+    def test_ranges_with_gaps_and_floor(self):
+        self.store.put_many(self.author, posts([0, 1, 2, 5, 7, 8]))
+        self.assertEqual(self.store.ranges(self.author), [[0, 2], [5, 5], [7, 8]])
+        self.store.set_retention(self.author, keep_posts=3)
+        self.store.put_many(self.author, posts([9]))
+        # Ids below the newest evicted one count as held, 6 is still missing
+        self.assertEqual(self.store.floor(self.author), 6)
+        self.assertEqual(self.store.ranges(self.author), [[0, 5], [7, 9]])
+        self.assertEqual(self.store.missing_ids(self.author, 9), [6])
+
+    def test_misses_and_missing_ids(self):
+        self.store.put_many(self.author, posts([0, 1, 2, 5, 7]))
+        self.assertFalse(self.store.misses(self.author, 2))
+        self.assertTrue(self.store.misses(self.author, 4))
+        self.assertEqual(self.store.missing_ids(self.author, 9), [3, 4, 6, 8, 9])
+        self.assertEqual(self.store.missing_ids(self.author, 9, limit=3), [3, 4, 6])
+        # Ids claimed by peers are bounded by what SQLite holds, and only the first ones are listed
+        self.assertTrue(self.store.misses(self.author, 2 ** 70))
+        self.assertEqual(self.store.missing_ids(self.author, 2 ** 70, limit=4), [3, 4, 6, 8])
+
+    def test_unknown_ids(self):
+        self.store.put_many(self.author, posts(range(600)))
+        self.assertEqual(self.store.unknown_ids(self.author, [5, 599, 600, 1000, 2 ** 70]), [600, 1000])
+
+    def test_missing_reads_only_gaps_up_to_last_id(self):
+        self.store.put_many(self.author, posts(range(20)))
+        self.assertEqual(list(self.store.missing(self.author, [[0, 3], [6, 9]])), [4, 5] + list(range(10, 20)))
+        self.assertEqual(list(self.store.missing(self.author, [[6, 9], [0, 3]], limit=3)), [4, 5, 10])
+        self.assertEqual(list(self.store.missing(self.author, [[0, 3], [6, 9]], last_id=9)), [4, 5])
+
+    def test_sweep_evicts_authors_that_stopped_posting(self):
+        self.store.set_retention(self.author, keep_days=1)
+        old = {id: dict(post, timestamp=time.time() - 3 * 86400) for id, post in posts(range(5)).items()}
+        self.store.connection.executemany(
+            "INSERT INTO posts (author, id, timestamp, text, signature) VALUES (?, ?, ?, ?, ?)",
+            [(self.keys.id_of(self.author), id, post["timestamp"], post["text"], post["signature"]) for id, post in old.items()])
+        self.store.sweep()
+        self.assertEqual(self.store.count(self.author), 0)
+        self.assertEqual(self.store.floor(self.author), 5)
+        self.assertEqual(self.store.ranges(self.author), [[0, 4]])
+
+
+if __name__ == "__main__":
+    unittest.main()
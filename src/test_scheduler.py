@@ -0,0 +1,103 @@
+import asyncio
+import unittest
+from Metrics import Metrics
+from Scheduler import Scheduler, INTERACTIVE, MAINTENANCE
+
+
+class SchedulerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.scheduler = Scheduler(Metrics(), workers=2)
+        self.scheduler.start()
+
+    async def asyncTearDown(self):
+        await self.scheduler.stop()
+
+    async def test_cancelled_caller_keeps_workers_alive(self):
+        release = asyncio.Event()
+
+        async def slow():
+            await release.wait()
+            return "slow"
+
+        waiters = [asyncio.ensure_future(self.scheduler.submit(MAINTENANCE, slow)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        release.set()
+
+        async def fast():
+            return "fast"
+
+        self.assertEqual(await asyncio.wait_for(self.scheduler.submit(MAINTENANCE, fast), 1), "fast")
+        self.assertTrue(all(not worker.done() for worker in self.scheduler.workers))
+
+    async def test_cancelled_waiting_job_is_replaced(self):
+        release = asyncio.Event()
+
+        async def block():
+            await release.wait()
+
+        blockers = [self.scheduler.submit(MAINTENANCE, block) for _ in range(2)]
+        await asyncio.sleep(0)
+        runs = []
+
+        async def job():
+            runs.append(1)
+            return len(runs)
+
+        self.scheduler.submit(MAINTENANCE, job, "key").cancel()
+        future = self.scheduler.submit(MAINTENANCE, job, "key")
+        release.set()
+        await asyncio.gather(*blockers)
+        self.assertEqual(await asyncio.wait_for(future, 1), 1)
+        self.assertEqual(runs, [1])
+
+    async def test_coalesce_and_upgrade(self):
+        release = asyncio.Event()
+
+        async def block():
+            await release.wait()
+
+        blockers = [self.scheduler.submit(MAINTENANCE, block) for _ in range(2)]
+        await asyncio.sleep(0)
+        order = []
+
+        def job(name):
+            async def run():
+                order.append(name)
+                return name
+            return run
+
+        low = self.scheduler.submit(MAINTENANCE, job("low"))
+        first = self.scheduler.submit(MAINTENANCE, job("first"), "key")
+        second = self.scheduler.submit(INTERACTIVE, job("second"), "key")
+        self.assertIs(first, second)
+        release.set()
+        await asyncio.gather(*blockers, low, first)
+        self.assertEqual(order, ["second", "low"])
+
+    async def test_running_key_is_held_and_requeued(self):
+        release = asyncio.Event()
+        runs = []
+
+        async def job():
+            runs.append(len(runs))
+            await release.wait()
+            return len(runs)
+
+        first = self.scheduler.submit(MAINTENANCE, job, "key")
+        await asyncio.sleep(0)
+        second = self.scheduler.submit(MAINTENANCE, job, "key")
+        self.assertIsNot(first, second)
+        await asyncio.sleep(0.01)
+        # Held until the running one is done, even with a free worker
+        self.assertEqual(runs, [0])
+        release.set()
+        await asyncio.wait_for(asyncio.gather(first, second), 1)
+        self.assertEqual(runs, [0, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
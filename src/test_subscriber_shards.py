@@ -0,0 +1,45 @@
+import json
+import time
+import unittest
+from SubscriberShards import MergingStorage
+
+
+def record(add=None, remove=None):
+    return json.dumps({"add": add or {}, "remove": remove or {}})
+
+
+class MergingStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = MergingStorage(tombstone_ttl=100)
+        self.now = time.time()
+
+    def stored(self, key="shard"):
+        return json.loads(self.storage.get(key))
+
+    def test_concurrent_writes_are_merged(self):
+        self.storage["shard"] = record({"a": self.now})
+        self.storage["shard"] = record({"b": self.now})
+        self.assertEqual(sorted(self.stored()["add"]), ["a", "b"])
+
+    def test_removed_adds_are_dropped(self):
+        self.storage["shard"] = record({"a": self.now - 2})
+        self.storage["shard"] = record(remove={"a": self.now - 1})
+        self.assertEqual(self.stored(), {"add": {}, "remove": {"a": self.now - 1}})
+        # A stale copy of the add doesn't bring it back
+        self.storage["shard"] = record({"a": self.now - 2})
+        self.assertEqual(self.stored()["add"], {})
+
+    def test_expired_tombstones_are_dropped(self):
+        self.storage["shard"] = record({"a": self.now - 300})
+        self.storage["shard"] = record(remove={"a": self.now - 200})
+        self.assertEqual(self.stored(), {"add": {}, "remove": {}})
+
+    def test_other_values_are_replaced(self):
+        self.storage["key"] = "first"
+        self.storage["key"] = "second"
+        self.assertEqual(self.storage.get("key"), "second")
+
+
+if __name__ == "__main__":
+    unittest.main()